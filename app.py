@@ -1,11 +1,16 @@
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
 import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from backtest_nifty import compute_level_scenario_stats, current_snapshot, open_context_label, read_excel_cached
 
 
 DATA_DIR = 'data'
@@ -33,182 +38,180 @@ def save_session_cache(data):
         pass
 
 
-@st.cache_data
-def load_data():
-    """Load all backtested statistics and compute aggregated level‑game scenarios."""
-    candle = pd.read_csv(os.path.join(DATA_DIR, 'candle_state_stats.csv'))
-    open_ctx = pd.read_csv(os.path.join(DATA_DIR, 'open_context_stats.csv'))
-    gap = pd.read_csv(os.path.join(DATA_DIR, 'gap_stats.csv'))
-    # Load raw level game data
-    level_raw = pd.read_csv(os.path.join(DATA_DIR, 'level_game_stats.csv'))
-
-    th_path = os.path.join(DATA_DIR, 'thresholds.json')
-    thresholds = {}
-    if os.path.exists(th_path):
-        with open(th_path) as f:
-            thresholds = json.load(f)
-
-    # Compute aggregated level game scenarios from raw data
-    level_stats = compute_level_scenario_stats(level_raw)
-
-    # try load raw historical OHLC if available for quick checks
-    hist = None
-    hist_paths = [os.path.join(DATA_DIR, 'historical.csv'), 'Nifty Data.xlsx', 'Nifty Data.csv']
-    for p in hist_paths:
-        if os.path.exists(p):
-            try:
-                if p.lower().endswith('.xlsx'):
-                    hist = pd.read_excel(p, header=2)
-                else:
-                    hist = pd.read_csv(p)
-                if 'Date' in hist.columns:
-                    hist['Date'] = pd.to_datetime(hist['Date'], dayfirst=True, errors='coerce')
-                    hist = hist.sort_values('Date').reset_index(drop=True)
-                break
-            except Exception:
-                hist = None
+# files the dashboard reads from the backtest output directory
+STATS_FILES = ('candle_state_stats.csv', 'open_context_stats.csv', 'gap_stats.csv',
+               'level_scenario_stats.csv', 'level_game_daily.csv', 'thresholds.json')
+HIST_PATHS = (os.path.join(DATA_DIR, 'historical.csv'), 'Nifty Data.xlsx', 'Nifty Data.csv')
+# seconds between background checks for new backtest results
+STATS_POLL_SECONDS = 30
+# threads reading stats files and the historical frame
+LOADER_WORKERS = 4
+
+
+def file_fingerprint(path, manifest=None):
+    """
+    Cheap change marker for a file: its SHA-256 from the snapshot manifest when
+    it is listed there, else (size, mtime); None if the file doesn't exist.
+    """
+    name = os.path.basename(path)
+    if manifest is not None and name in manifest['files']:
+        return manifest['files'][name]['sha256']
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return info.st_size, info.st_mtime_ns
+
+
+def stats_fingerprints():
+    """(directory holding the current stats, {file name: fingerprint}) for every file in STATS_FILES."""
+    # resolve current.json once so every table comes from the same snapshot (--snapshot runs)
+    manifest = current_snapshot(DATA_DIR)
+    stats_dir = DATA_DIR if manifest is None else os.path.join(DATA_DIR, manifest['path'])
+    return stats_dir, {name: file_fingerprint(os.path.join(stats_dir, name), manifest) for name in STATS_FILES}
+
+
+# Each file is cached on its own, keyed by name and fingerprint; the leading
+# underscore keeps the path out of the cache key, so a new snapshot holding an
+# unchanged copy of a table reuses the cached frame. Room for two versions of
+# every file, so caching a changed table never evicts an unchanged one. No
+# spinner: these run on loader_pool threads, several at once.
+@st.cache_data(max_entries=2 * len(STATS_FILES), show_spinner=False)
+def read_stats_csv(name, fingerprint, _path):
+    return pd.read_csv(_path)
+
+
+@st.cache_data(max_entries=4)
+def read_thresholds(fingerprint, _path):
+    if fingerprint is None:
+        return {}
+    with open(_path) as f:
+        return json.load(f)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def level_scenario_stats_from_daily(fingerprint, _path):
+    # outputs from before level_scenario_stats.csv existed: aggregate the per-day table here
+    return compute_level_scenario_stats(pd.read_csv(_path))
+
+
+def read_history(path):
+    """Raw historical OHLC for quick checks, or None if `path` can't be read."""
+    try:
+        if path.lower().endswith('.xlsx'):
+            hist = read_excel_cached(path, header=2)
+        else:
+            hist = pd.read_csv(path)
+        if 'Date' in hist.columns:
+            hist['Date'] = pd.to_datetime(hist['Date'], dayfirst=True, errors='coerce')
+            hist = hist.sort_values('Date').reset_index(drop=True)
+        return hist
+    except Exception:
+        return None
+
+
+def first_history(paths):
+    # the first of `paths` that reads, as listed in HIST_PATHS
+    for path in paths:
+        hist = read_history(path)
+        if hist is not None:
+            return hist
+    return None
 
-    return candle, open_ctx, gap, level_stats, thresholds, hist
 
+@st.cache_resource
+def loader_pool():
+    """Thread pool shared by every session for file reads."""
+    return ThreadPoolExecutor(max_workers=LOADER_WORKERS, thread_name_prefix='load_data')
 
-def compute_level_scenario_stats(level_raw):
+
+# The frame is shared by all sessions rather than copied out of st.cache_data
+# on every rerun, so callers must not modify it.
+@st.cache_resource(max_entries=1)
+def history_future(paths, fingerprints):
+    """Future for the historical OHLC frame, read in the background once per set of file fingerprints."""
+    return loader_pool().submit(first_history, paths)
+
+
+def build_stats_index(candle, open_ctx, gap, level_stats):
     """
-    Process raw level game data (one row per level per day) into aggregated scenario statistics.
-    Returns a DataFrame with columns: scenario, outcome, total_count, outcome_count, probability.
-    The scenarios and outcomes match the user's desired Level Game table.
+    Compile the stats tables into the dicts the pages look edges up in:
+    `candle` by candle_state, `open` by open_context and `gap` by
+    (gap_direction, gap_bucket), each mapping to the row as a dict;
+    `scenarios` maps a Level Game scenario to its outcome rows in file order.
+    `gap_fill_columns` lists the gap table's prob_fill_<N>pct columns.
     """
-    # Pivot the raw data to get one row per day with all levels
-    # First, ensure Date is parsed
-    level_raw['Date'] = pd.to_datetime(level_raw['Date'], errors='coerce')
-    # Get unique dates and the first row per date (all levels share the same OHLC values)
-    daily = level_raw.groupby('Date').first().reset_index()
-    # Add back the level-specific flags by merging? Actually we need to know per day what happened at each level.
-    # Better to keep the raw data and later join. For scenario evaluation, we need for each day:
-    # - Open, High, Low, Close (from daily)
-    # - For each level: FirstTouch, Broken, AfterBreakRetouch, BreakSuccess.
-    # We can create a pivot table with level as columns.
-    pivot = level_raw.pivot(index='Date', columns='Level', values=['FirstTouch', 'Broken', 'AfterBreakRetouch', 'BreakSuccess'])
-    # Flatten column names
-    pivot.columns = [f"{col[0]}_{col[1]}" for col in pivot.columns]
-    pivot = pivot.reset_index()
-    # Merge with daily OHLC
-    daily = daily[['Date', 'Open', 'High', 'Low', 'Close']].merge(pivot, on='Date', how='left')
-
-    # Now daily contains all necessary data per day.
-    # Define scenarios as a list of (scenario_name, condition_func, outcomes_list)
-    # Each outcome is a (outcome_name, outcome_condition_func)
-    # We'll evaluate each row and accumulate counts.
-
-    records = []
-
-    # Helper functions to check conditions
-    def touched_bc(row):
-        return row.get('FirstTouch_BC', False)
-
-    def touched_tc(row):
-        return row.get('FirstTouch_TC', False)
-
-    def touched_pdh(row):
-        return row.get('FirstTouch_PDH', False)
-
-    def touched_pdl(row):
-        return row.get('FirstTouch_PDL', False)
-
-    def broken_tc_up(row):
-        # Open below BC and high > TC
-        return (row['Open'] < row.get('BC', -float('inf'))) and (row['High'] > row.get('TC', -float('inf')))
-
-    def broken_bc_down(row):
-        # Open above TC and low < BC
-        return (row['Open'] > row.get('TC', float('inf'))) and (row['Low'] < row.get('BC', float('inf')))
-
-    def gap_fill(row):
-        # We need gap direction and fill; but we don't have gap in level_raw. We'll skip gap scenarios here.
-        # They are already covered by gap_stats.csv.
-        return False
-
-    # We'll only implement the scenarios that can be derived from level_raw.
-    # For gap scenarios, we will rely on gap_df in the dashboard.
-    # The 11 scenarios from the user's table include gap scenarios, but we'll handle those separately.
-    # For now, we'll compute only the CPR-related and touch scenarios.
-
-    scenarios = [
-        # 1. Open below BC
-        ('Open below BC',
-         lambda row: row['Open'] < row.get('BC', -float('inf')),
-         [('Touched BC', lambda row: row.get('FirstTouch_BC', False)),
-          ('Never touched BC', lambda row: not row.get('FirstTouch_BC', False))]),
-
-        # 2. Open below BC & Touched BC
-        ('Open below BC & Touched BC',
-         lambda row: (row['Open'] < row.get('BC', -float('inf'))) and row.get('FirstTouch_BC', False),
-         [('Breaks TC', lambda row: row.get('Broken_TC', False) and row.get('BrokenDirection_TC') == 'Up'),  # Note: we don't have BrokenDirection in raw? Actually we have Broken_TC which is True if high > TC. That's enough.
-          ('Closes below BC', lambda row: row['Close'] < row.get('BC', -float('inf')))]),
-
-        # 3. Open below BC & No touch BC
-        ('Open below BC & No touch BC',
-         lambda row: (row['Open'] < row.get('BC', -float('inf'))) and (not row.get('FirstTouch_BC', False)),
-         [('Breaks Prev Low', lambda row: row.get('Broken_PDL', False) and row.get('BrokenDirection_PDL') == 'Down')]),
-
-        # 4. Open above TC
-        ('Open above TC',
-         lambda row: row['Open'] > row.get('TC', float('inf')),
-         [('Touched TC', lambda row: row.get('FirstTouch_TC', False)),
-          ('Never touched TC', lambda row: not row.get('FirstTouch_TC', False))]),
-
-        # 5. Open above TC & Touched TC
-        ('Open above TC & Touched TC',
-         lambda row: (row['Open'] > row.get('TC', float('inf'))) and row.get('FirstTouch_TC', False),
-         [('Breaks BC', lambda row: row.get('Broken_BC', False) and row.get('BrokenDirection_BC') == 'Down'),
-          ('Closes above TC', lambda row: row['Close'] > row.get('TC', float('inf')))]),
-
-        # 6. Open inside CPR
-        ('Open inside CPR',
-         lambda row: (row['Open'] >= row.get('BC', -float('inf'))) and (row['Open'] <= row.get('TC', float('inf'))),
-         [('Closes above TC', lambda row: row['Close'] > row.get('TC', float('inf'))),
-          ('Closes below BC', lambda row: row['Close'] < row.get('BC', -float('inf'))),
-          ('Closes within CPR', lambda row: (row['Close'] >= row.get('BC', -float('inf'))) and (row['Close'] <= row.get('TC', float('inf'))))]),
-
-        # 7. Touched Prev Day High
-        ('Touched Prev Day High',
-         lambda row: row.get('FirstTouch_PDH', False),
-         [('Rejection at PDH', lambda row: (row['High'] > row.get('PDH', -float('inf'))) and (row['Close'] < row.get('PDH', -float('inf')))),
-          ('Strong breakout above PDH', lambda row: (row['High'] > row.get('PDH', -float('inf'))) and (row['Close'] > row.get('PDH', -float('inf'))))]),
-
-        # 8. Touched Prev Day Low
-        ('Touched Prev Day Low',
-         lambda row: row.get('FirstTouch_PDL', False),
-         [('Bounce from PDL', lambda row: (row['Low'] < row.get('PDL', float('inf'))) and (row['Close'] > row.get('PDL', float('inf')))),
-          ('Strong breakdown below PDL', lambda row: (row['Low'] < row.get('PDL', float('inf'))) and (row['Close'] < row.get('PDL', float('inf'))))]),
-
-        # 11. Breaks TC from below (Open < BC & high > TC)
-        ('Breaks TC from below',
-         lambda row: (row['Open'] < row.get('BC', -float('inf'))) and (row['High'] > row.get('TC', -float('inf'))),
-         [('Closes above TC', lambda row: row['Close'] > row.get('TC', float('inf'))),
-          ('Closes below BC', lambda row: row['Close'] < row.get('BC', -float('inf')))]),
-    ]
-
-    for scenario_name, cond_func, outcomes in scenarios:
-        mask = daily.apply(cond_func, axis=1)
-        total = mask.sum()
-        if total == 0:
-            continue
-        for outcome_name, out_cond_func in outcomes:
-            outcome_mask = mask & daily.apply(out_cond_func, axis=1)
-            outcome_count = outcome_mask.sum()
-            records.append({
-                'scenario': scenario_name,
-                'outcome': outcome_name,
-                'total_count': total,
-                'outcome_count': outcome_count,
-                'probability': outcome_count / total if total > 0 else 0
-            })
-
-    result_df = pd.DataFrame(records)
-    # Convert any string columns to plain object type to avoid Arrow issues
-    for col in result_df.select_dtypes(include=['string']).columns:
-        result_df[col] = result_df[col].astype(str)
-    return result_df
+    return {
+        'candle': candle.set_index('candle_state').to_dict('index'),
+        'open': open_ctx.set_index('open_context').to_dict('index'),
+        'gap': gap.set_index(['gap_direction', 'gap_bucket']).to_dict('index'),
+        'gap_fill_columns': [c for c in gap.columns if c.startswith('prob_fill_')],
+        'scenarios': {scenario: rows.to_dict('records')
+                      for scenario, rows in level_stats.groupby('scenario', sort=False)},
+    }
+
+
+def submit_in_context(pool, fn, *args):
+    """`pool.submit(fn, *args)`, with fn (an st.cache_data function) run under the calling script run's context."""
+    ctx = get_script_run_ctx()
+
+    def run():
+        thread = threading.current_thread()
+        add_script_run_ctx(thread, ctx)
+        try:
+            return fn(*args)
+        finally:
+            add_script_run_ctx(thread, None)  # pool threads outlive this script run
+
+    return pool.submit(run)
+
+
+# Built once per set of stats files and shared by all sessions and reruns, so
+# callers must not modify it.
+@st.cache_resource(max_entries=2)
+def load_stats(stats_dir, fingerprints):
+    """Read the stats tables concurrently and compile them with `build_stats_index`."""
+    pool = loader_pool()
+
+    def table(name):
+        return submit_in_context(pool, read_stats_csv, name, fingerprints[name], os.path.join(stats_dir, name))
+
+    candle = table('candle_state_stats.csv')
+    open_ctx = table('open_context_stats.csv')
+    gap = table('gap_stats.csv')
+    if fingerprints['level_scenario_stats.csv'] is not None:
+        level_stats = table('level_scenario_stats.csv')
+    else:
+        level_stats = submit_in_context(pool, level_scenario_stats_from_daily, fingerprints['level_game_daily.csv'],
+                                        os.path.join(stats_dir, 'level_game_daily.csv'))
+    return build_stats_index(candle.result(), open_ctx.result(), gap.result(), level_stats.result())
+
+
+def load_data():
+    """
+    Load all backtested statistics as (stats index, thresholds, historical
+    future). Only files whose fingerprint changed since they were last read
+    are read again; see `build_stats_index` for the index.
+
+    The historical OHLC is only needed for the Welcome page's historical check,
+    so instead of a frame this returns a future for it (None when no historical
+    file exists) and the check waits on it.
+    """
+    stats_dir, fingerprints = stats_fingerprints()
+    hist_paths = tuple(p for p in HIST_PATHS if os.path.exists(p))
+    hist = history_future(hist_paths, tuple(file_fingerprint(p) for p in hist_paths)) if hist_paths else None
+    thresholds = read_thresholds(fingerprints['thresholds.json'], os.path.join(stats_dir, 'thresholds.json'))
+    return load_stats(stats_dir, fingerprints), thresholds, hist
+
+
+@st.fragment(run_every=STATS_POLL_SECONDS)
+def watch_stats_files():
+    """Rerun the app when a backtest has rewritten the stats files since this session last loaded them."""
+    fingerprints = stats_fingerprints()[1]
+    seen = st.session_state.setdefault('stats_fingerprints', fingerprints)
+    if fingerprints != seen:
+        st.session_state['stats_fingerprints'] = fingerprints
+        st.rerun(scope='app')
 
 
 def compute_cpr(prev_h, prev_l, prev_c):
@@ -275,7 +278,7 @@ def bucket_gap(pct):
     return '>2%'
 
 
-def welcome_page(candle_df, open_df, gap_df, level_stats, thresholds, hist_df=None):
+def welcome_page(stats, thresholds, hist_future=None):
     st.title('🎯 NIFTY Edge Dashboard - Welcome')
     st.markdown('---')
     st.markdown('**Enter previous day OHLC and today\'s open to compute edges**')
@@ -333,35 +336,11 @@ def welcome_page(candle_df, open_df, gap_df, level_stats, thresholds, hist_df=No
                        wick_imb=wick_imb, top_rej=top_rej, bot_rej=bot_rej)
         candle_state = classify_candle_from_thresholds(metrics, thresholds)
 
-        # open context
-        if today_open > prev_high:
-            pos = 'Open_Above_PDH'
-        elif today_open < prev_low:
-            pos = 'Open_Below_PDL'
-        else:
-            pos = 'Open_Inside_Prev_Range'
-
-        if today_open > tc:
-            cpr_pos = 'Above_CPR'
-        elif today_open < bc:
-            cpr_pos = 'Below_CPR'
-        else:
-            cpr_pos = 'Inside_CPR'
-
-        # Quartile classification: only applies when open is INSIDE previous range
-        if pos == 'Open_Inside_Prev_Range':
-            if prev_range == 0:
-                quart = 'Open_Middle_Half'
-            else:
-                if (prev_high - today_open) / prev_range < 0.25:
-                    quart = 'Open_Top_Quartile'
-                elif (today_open - prev_low) / prev_range < 0.25:
-                    quart = 'Open_Bottom_Quartile'
-                else:
-                    quart = 'Open_Middle_Half'
-            open_context = f"{pos}|{cpr_pos}|{quart}"
-        else:
-            open_context = f"{pos}|{cpr_pos}"
+        # open context (shared engine with the backtest so the strings cannot drift)
+        open_context = open_context_label(today_open, prev_high, prev_low, tc, bc, prev_range)
+        parts = open_context.split('|')
+        pos, cpr_pos = parts[0], parts[1]
+        quart = parts[2] if len(parts) > 2 else None
 
         gap = today_open - prev_close
         gap_dir = 'Gap_Up' if gap > 0 else ('Gap_Down' if gap < 0 else 'No_Gap')
@@ -416,6 +395,10 @@ def welcome_page(candle_df, open_df, gap_df, level_stats, thresholds, hist_df=No
         col3.metric('Quartile', quart if pos == 'Open_Inside_Prev_Range' else '—', help='Position within previous range')
 
         # show historical actual next-day outcome if historical loaded
+        hist_df = None
+        if hist_future is not None:
+            with st.spinner('Loading historical data...'):
+                hist_df = hist_future.result()
         if hist_df is not None:
             try:
                 sd = pd.to_datetime(st_date)
@@ -464,7 +447,7 @@ def welcome_page(candle_df, open_df, gap_df, level_stats, thresholds, hist_df=No
     st.info('Use the sidebar 👈 to navigate to **Edge Detection** page')
 
 
-def edge_detection_page(candle_df, open_df, gap_df, level_stats, thresholds):
+def edge_detection_page(stats, thresholds):
     st.title('🔍 Edge Detection')
     if 'edge_result' not in st.session_state or not st.session_state['edge_result']:
         # Try load from cache
@@ -482,9 +465,8 @@ def edge_detection_page(candle_df, open_df, gap_df, level_stats, thresholds):
     with st.container():
         st.markdown('### 🕯️ Candle Structure Game')
         st.markdown(f"**Classified Candle State:** `{er['candle_state']}`")
-        row = candle_df[candle_df['candle_state'] == er['candle_state']]
-        if not row.empty:
-            r = row.iloc[0]
+        r = stats['candle'].get(er['candle_state'])
+        if r is not None:
             st.metric('Sample Size', int(r['total_count']), help='Number of historical occurrences of this candle state')
             
             fig = make_subplots(rows=1, cols=3, specs=[[{'type': 'indicator'}, {'type': 'indicator'}, {'type': 'indicator'}]])
@@ -551,19 +533,16 @@ def edge_detection_page(candle_df, open_df, gap_df, level_stats, thresholds):
         # But we could optionally include them if the user wants them in Level Game.
         # For now, we leave them to Gap Game.
 
-        # Remove duplicates
-        scenario_names = list(set(scenario_names))
-
-        # Filter level_stats by these scenario names
-        if not level_stats.empty:
-            relevant = level_stats[level_stats['scenario'].isin(scenario_names)].copy()
-            if not relevant.empty:
-                # Group by scenario and display
-                for scenario in sorted(relevant['scenario'].unique()):
-                    sub = relevant[relevant['scenario'] == scenario]
-                    total = sub['total_count'].iloc[0]  # same for all outcomes of this scenario
+        # Remove duplicates and scenarios without statistics
+        relevant = sorted(name for name in set(scenario_names) if name in stats['scenarios'])
+
+        if stats['scenarios']:
+            if relevant:
+                for scenario in relevant:
+                    outcomes = stats['scenarios'][scenario]
+                    total = outcomes[0]['total_count']  # same for all outcomes of this scenario
                     with st.expander(f"**{scenario}** (Sample: {total})", expanded=False):
-                        for _, row in sub.iterrows():
+                        for row in outcomes:
                             prob = row['probability']
                             outcome = row['outcome']
                             count = row['outcome_count']
@@ -575,18 +554,20 @@ def edge_detection_page(candle_df, open_df, gap_df, level_stats, thresholds):
 
     st.markdown('---')
 
-    # Gap Game - Styled Container (unchanged, but ensure gap_df is loaded)
+    # Gap Game - Styled Container
     with st.container():
         st.markdown('### 📉 Gap Game')
         st.markdown(f"**Gap Direction:** `{er['gap_dir']}` | **Gap Bucket:** `{er['gap_bucket']}`")
         
         if er['gap_bucket'] is not None:
-            row = gap_df[(gap_df['gap_direction'] == er['gap_dir']) & (gap_df['gap_bucket'] == er['gap_bucket'])]
-            if not row.empty:
-                r = row.iloc[0]
-                vals = [float(r['prob_fill_50pct']), float(r['prob_fill_80pct']), float(r['prob_fill_100pct'])]
-                labels = ['50% Fill', '80% Fill', '100% Fill']
-                colors = ['#95a5a6', '#f39c12', '#27ae60']
+            r = stats['gap'].get((er['gap_dir'], er['gap_bucket']))
+            if r is not None:
+                # one bar per fill level written by the backtest (prob_fill_<N>pct)
+                fill_cols = stats['gap_fill_columns']
+                vals = [float(r[c]) for c in fill_cols]
+                labels = [c[len('prob_fill_'):-len('pct')] + '% Fill' for c in fill_cols]
+                palette = ['#95a5a6', '#f39c12', '#27ae60', '#3498db', '#9b59b6']
+                colors = [palette[i % len(palette)] for i in range(len(fill_cols))]
                 
                 fig3 = go.Figure(go.Bar(
                     x=labels, 
@@ -615,18 +596,18 @@ def edge_detection_page(candle_df, open_df, gap_df, level_stats, thresholds):
         # Retrieve computed probability scores for synthesis
         try:
             # Candle Game probabilities
-            candle_row = candle_df[candle_df['candle_state'] == er['candle_state']]
-            candle_bull = float(candle_row.iloc[0]['prob_trend_up']) if not candle_row.empty else 0
-            candle_bear = float(candle_row.iloc[0]['prob_trend_down']) if not candle_row.empty else 0
+            candle_row = stats['candle'].get(er['candle_state'])
+            candle_bull = float(candle_row['prob_trend_up']) if candle_row is not None else 0
+            candle_bear = float(candle_row['prob_trend_down']) if candle_row is not None else 0
             
-            # Level Game probabilities (use open context stats for trend, as level_stats doesn't have trend up/down)
-            level_row = open_df[open_df['open_context'] == er['open_context']]
-            level_bull = float(level_row.iloc[0]['prob_trend_up']) if not level_row.empty else 0
-            level_bear = float(level_row.iloc[0]['prob_trend_down']) if not level_row.empty else 0
+            # Level Game probabilities (use open context stats for trend, as the scenario stats don't have trend up/down)
+            level_row = stats['open'].get(er['open_context'])
+            level_bull = float(level_row['prob_trend_up']) if level_row is not None else 0
+            level_bear = float(level_row['prob_trend_down']) if level_row is not None else 0
             
             # Gap Game probabilities - determine most likely outcome
-            gap_row = gap_df[(gap_df['gap_direction'] == er['gap_dir']) & (gap_df['gap_bucket'] == er['gap_bucket'])]
-            gap_fill_prob = float(gap_row.iloc[0]['prob_fill_100pct']) if not gap_row.empty else 0
+            gap_row = stats['gap'].get((er['gap_dir'], er['gap_bucket']))
+            gap_fill_prob = float(gap_row['prob_fill_100pct']) if gap_row is not None else 0
             
             # Compute weighted consensus (simple average)
             consensus_bull = (candle_bull + level_bull) / 2.0
@@ -833,12 +814,13 @@ def main():
     page = st.sidebar.radio('Go to', pages, index=default_index)
 
     # Load all data files
-    candle_df, open_df, gap_df, level_stats, thresholds, hist_df = load_data()
+    stats, thresholds, hist_future = load_data()
+    watch_stats_files()
 
     if page == 'Welcome':
-        welcome_page(candle_df, open_df, gap_df, level_stats, thresholds, hist_df)
+        welcome_page(stats, thresholds, hist_future)
     elif page == 'Edge Detection':
-        edge_detection_page(candle_df, open_df, gap_df, level_stats, thresholds)
+        edge_detection_page(stats, thresholds)
     elif page == 'Trade Logging':
         trade_logging_page()
     elif page == 'Insight':
@@ -10,18 +10,34 @@ writes multiple CSVs into the output directory:
   - candle_state_stats.csv
   - open_context_stats.csv
   - gap_stats.csv
-  - level_game_stats.csv
+  - level_game_daily.csv
 
 Defaults are set to the provided file path; adjust CLI args as needed.
 """
 import argparse
+import contextlib
+import cProfile
+import hashlib
+import itertools
+import json
+import multiprocessing
+import operator
 import os
+import shutil
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Optional
 
 import numpy as np
 import pandas as pd
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
 
 def find_ohlc_cols(cols: pd.Index):
     # Try to find best-matching names for Open, High, Low, Close columns.
@@ -40,16 +56,113 @@ def find_ohlc_cols(cols: pd.Index):
 
 
 def safe_div(a, b):
-    return np.where((b == 0) | pd.isna(b), np.nan, a / b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where((b == 0) | pd.isna(b), np.nan, a / b)
 
 
-def classify_previous_candle(df):
-    # compute rolling percentiles (20, min 10) on Body% and shift so percentiles
-    # represent values up to previous day when classifying "previous day".
-    body_pct = df['body_pct_prev']
-    p70 = body_pct.rolling(window=20, min_periods=10).quantile(0.7).shift(1)
-    p30 = body_pct.rolling(window=20, min_periods=10).quantile(0.3).shift(1)
+def add_prev_day_features(df):
+    """Add previous-day levels, CPR and candle-structure ratios used by the classifiers."""
+    # previous day metrics
+    df['PDH'] = df['High'].shift(1)
+    df['PDL'] = df['Low'].shift(1)
+    df['PDC'] = df['Close'].shift(1)
+    df['PDO'] = df['Open'].shift(1)
+    df['prev_close'] = df['PDC']
+    df['prev_range'] = df['PDH'] - df['PDL']
+
+    # CPR
+    df['PP'] = (df['PDH'] + df['PDL'] + df['PDC']) / 3.0
+    df['BC'] = (df['PDH'] + df['PDL']) / 2.0
+    df['TC'] = (df['PP'] - df['BC']) + df['PP']
+    # Swap if TC < BC to ensure TC is max and BC is min
+    swap_mask = df['TC'] < df['BC']
+    df.loc[swap_mask, ['TC', 'BC']] = df.loc[swap_mask, ['BC', 'TC']].values
+    df['CPR_width'] = df['TC'] - df['BC']
+
+    # candle structure metrics for previous day
+    df['range_prev'] = df['prev_range']
+    df['body_prev'] = (df['PDC'] - df['PDO']).abs()
+    df['upper_wick_prev'] = df['PDH'] - df[['PDO', 'PDC']].max(axis=1)
+    df['lower_wick_prev'] = df[['PDO', 'PDC']].min(axis=1) - df['PDL']
+
+    df['body_pct_prev'] = safe_div(df['body_prev'], df['range_prev'])
+    df['upper_wick_pct_prev'] = safe_div(df['upper_wick_prev'], df['range_prev'])
+    df['lower_wick_pct_prev'] = safe_div(df['lower_wick_prev'], df['range_prev'])
+    df['wick_imbalance_prev'] = safe_div(df['upper_wick_prev'] - df['lower_wick_prev'], df['range_prev'])
+    df['top_rejection_prev'] = safe_div(df['PDH'] - df['PDC'], df['range_prev'])
+    df['bottom_rejection_prev'] = safe_div(df['PDC'] - df['PDL'], df['range_prev'])
+
+
+def add_next_day_columns(df):
+    df['next_high'] = df['High'].shift(-1)
+    df['next_low'] = df['Low'].shift(-1)
+    df['next_close'] = df['Close'].shift(-1)
+    df['next_open'] = df['Open'].shift(-1)
+
+
+# Tag vocabularies. Every '|'-joined label family (candle_state, open_context,
+# next_day_outcome) can also be held as a small integer bitmask with one bit
+# per tag, in the order the tags appear in the joined string.
+CANDLE_BASE_STATES = ('Balanced_Neutral', 'Strong_Acceptance', 'Exhaustion_Rejection',
+                      'Expansion', 'Compression')
+CANDLE_TAGS = ('Upper_Wick_Dominant', 'Lower_Wick_Dominant', 'Close_Near_High', 'Close_Near_Low')
+OPEN_POSITIONS = ('Open_Above_PDH', 'Open_Below_PDL', 'Open_Inside_Prev_Range')
+CPR_POSITIONS = ('Above_CPR', 'Below_CPR', 'Inside_CPR')
+OPEN_QUARTILES = ('Open_Top_Quartile', 'Open_Bottom_Quartile', 'Open_Middle_Half')
+NEXT_DAY_TRENDS = ('Trend_Up_Day', 'Trend_Down_Day', 'Range_Chop_Day')
+BREAK_TAGS = ('False_PDH_Break', 'False_PDL_Break', 'PDH_Break_Success', 'PDL_Break_Success')
+RANGE_TAGS = ('Expansion_Day', 'Normal_Range_Day')
+
+TAG_FAMILIES = {
+    'candle_state': CANDLE_BASE_STATES + CANDLE_TAGS,
+    'open_context': OPEN_POSITIONS + CPR_POSITIONS + OPEN_QUARTILES + ('Unknown',),
+    'next_day_outcome': NEXT_DAY_TRENDS + BREAK_TAGS + RANGE_TAGS,
+}
+
+
+def _decode_table(tags):
+    # '|'-joined string for every possible mask; mask 0 (no tags) decodes to NaN.
+    table = np.empty(1 << len(tags), dtype=object)
+    table[0] = np.nan
+    for mask in range(1, len(table)):
+        table[mask] = '|'.join(t for i, t in enumerate(tags) if mask & (1 << i))
+    return table
+
+
+_DECODE_TABLES = {family: _decode_table(tags) for family, tags in TAG_FAMILIES.items()}
+
+
+def tag_mask(family, *tags):
+    """Bitmask with the bit of every given tag set, e.g. tag_mask('candle_state', 'Close_Near_High')."""
+    vocab = TAG_FAMILIES[family]
+    mask = 0
+    for tag in tags:
+        if tag not in vocab:
+            raise ValueError(f'{tag!r} is not a {family} tag')
+        mask |= 1 << vocab.index(tag)
+    return mask
+
+
+def encode_tags(values, family):
+    """Convert '|'-joined label strings to uint16 bitmasks (0 for missing labels)."""
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    lookup = np.array([tag_mask(family, *u.split('|')) for u in uniques] + [0], dtype=np.uint16)
+    return lookup[codes]
+
+
+def decode_tags(masks, family):
+    """Convert bitmasks back to the '|'-joined label strings written to the CSVs."""
+    return _DECODE_TABLES[family][np.asarray(masks, dtype=np.intp)]
+
 
+def has_tags(masks, family, *tags):
+    """Boolean array: which masks contain all of `tags` (e.g. any state with Close_Near_High)."""
+    wanted = tag_mask(family, *tags)
+    return (np.asarray(masks) & wanted) == wanted
+
+
+def _classify_previous_candle_loop(df, p70, p30):
+    # Reference engine: row-by-row classification, kept for parity checks.
     states = []
     for idx, row in df.iterrows():
         bp = row['body_pct_prev']
@@ -89,19 +202,189 @@ def classify_previous_candle(df):
         if tags:
             state = state + '|' + '|'.join(tags)
         states.append(state)
-
-    df['candle_state'] = states
-
-
-def classify_open_context(df):
+    return states
+
+
+def _classify_previous_candle_vectorized(df, p70, p30, thresholds):
+    bp = df['body_pct_prev'].to_numpy(dtype=float)
+    up = df['upper_wick_pct_prev'].to_numpy(dtype=float)
+    lo = df['lower_wick_pct_prev'].to_numpy(dtype=float)
+    wick_imb = df['wick_imbalance_prev'].to_numpy(dtype=float)
+    top_rej = df['top_rejection_prev'].to_numpy(dtype=float)
+    bot_rej = df['bottom_rejection_prev'].to_numpy(dtype=float)
+    hi = p70.to_numpy(dtype=float)
+    lw = p30.to_numpy(dtype=float)
+
+    # NaN comparisons are False, which matches the loop's fall-through to
+    # Balanced_Neutral once the explicit NaN guard is applied.
+    valid = ~(np.isnan(hi) | np.isnan(lw) | np.isnan(bp))
+    small, mid, large = thresholds['small_wick'], thresholds['mid_wick'], thresholds['large_wick']
+    base = np.select(
+        [valid & (bp > hi) & (up < small) & (lo < small),
+         valid & (bp < lw) & ((up > large) | (lo > large)),
+         valid & (bp > hi) & ((up > mid) | (lo > mid)),
+         valid & (bp < lw) & (up < mid) & (lo < mid)],
+        [1, 2, 3, 4],
+        default=0,
+    )
+    tags = ((wick_imb > 0.3).astype(np.uint16)
+            | ((wick_imb < -0.3).astype(np.uint16) << 1)
+            | ((top_rej < 0.2).astype(np.uint16) << 2)
+            | ((bot_rej < 0.2).astype(np.uint16) << 3))
+    return (np.uint16(1) << base.astype(np.uint16)) | (tags << len(CANDLE_BASE_STATES))
+
+
+def rolling_quantiles(values, window, quantiles, min_periods=None):
     """
-    Classify open context relative to previous day's range and CPR.
-    
-    FIXED: Quartile tags (Open_Top_Quartile, Open_Bottom_Quartile, Open_Middle_Half)
-    are now ONLY appended if the open is INSIDE the previous day's range.
-    If open is outside the range (Above_PDH or Below_PDL), quartile tags are NOT added
-    to match dashboard-compatible strings.
+    Trailing rolling quantiles of `values` for several `quantiles` in one pass.
+
+    Column j equals pd.Series(values).rolling(window, min_periods).quantile(quantiles[j])
+    (linear interpolation, NaNs and, as in pandas, ±inf skipped, NaN below
+    `min_periods` observations, which defaults to `window`). Returns a
+    (len(values), len(quantiles)) array.
+
+    The series is cut into blocks of up to 65535 values. Within a block each value is
+    replaced by its rank (uint16, NaNs ranked last), so all the block's windows can be
+    sorted with one vectorized small-integer sort, and every quantile is read off the
+    same sorted rows. Cost is O(n * window * log(window)) vectorized, independent of
+    the number of quantiles.
     """
+    x = np.asarray(values, dtype=float)
+    x = np.where(np.isinf(x), np.nan, x)  # pandas' rolling windows treat ±inf as missing too
+    q = np.asarray(quantiles, dtype=float)
+    min_periods = window if min_periods is None else min_periods
+    n = len(x)
+    out = np.full((n, len(q)), np.nan)
+    if n == 0:
+        return out
+    rank_dtype = np.uint16 if window <= 1 << 14 else np.uint32
+    span = (1 << 16) - 1 if rank_dtype is np.uint16 else window - 1 + (1 << 16)
+    per_block = span - (window - 1)
+    rows_per_sort = max(1, (1 << 22) // window)  # keeps each sorted (rows x window) matrix ~8 MB
+
+    # windows ending before index window - 1 are partial: pad the front with NaN
+    padded = np.concatenate([np.full(window - 1, np.nan), x])
+    valid = np.concatenate([[0], np.cumsum(~np.isnan(padded))])
+    nobs = valid[window:] - valid[:-window]  # non-NaN values in the window ending at each row
+
+    for start in range(0, n, per_block):
+        stop = min(start + per_block, n)
+        block = padded[start:stop + window - 1]
+        order = np.argsort(block)
+        sorted_block = block[order]
+        ranks = np.empty(len(block), dtype=rank_dtype)
+        ranks[order] = np.arange(len(block), dtype=rank_dtype)
+        windows = np.lib.stride_tricks.sliding_window_view(ranks, window)
+        for lo in range(0, stop - start, rows_per_sort):
+            hi = min(lo + rows_per_sort, stop - start)
+            sorted_ranks = np.sort(windows[lo:hi], axis=1)
+            m = nobs[start + lo:start + hi]
+            pos = q[None, :] * (m[:, None] - 1)
+            below = np.floor(pos).astype(np.intp)
+            np.clip(below, 0, window - 1, out=below)
+            above = np.minimum(below + 1, np.maximum(m[:, None] - 1, 0))
+            v_low = sorted_block[np.take_along_axis(sorted_ranks, below, axis=1)]
+            v_high = sorted_block[np.take_along_axis(sorted_ranks, above, axis=1)]
+            # same arithmetic as pandas' skiplist quantile, so results match bit for bit
+            with np.errstate(invalid='ignore'):
+                result = np.where(pos == below, v_low, v_low + (v_high - v_low) * (pos - below))
+            result[m < max(min_periods, 1)] = np.nan
+            out[start + lo:start + hi] = result
+    return out
+
+
+BODY_PCT_WINDOW = 20
+
+# Tunable cutoffs of the vectorized classifiers (the reference loops keep the
+# original literals). Body% percentiles use a `body_window` rolling window
+# (min half of it); `small_wick`/`mid_wick`/`large_wick` split the base candle
+# states; a next day is a trend day when body/range > `trend_body` and an
+# expansion day when its range > `expansion_ratio` x the previous range.
+CLASSIFIER_THRESHOLDS = {
+    'body_window': BODY_PCT_WINDOW,
+    'body_high_q': 0.7,
+    'body_low_q': 0.3,
+    'small_wick': 0.2,
+    'mid_wick': 0.3,
+    'large_wick': 0.4,
+    'trend_body': 0.6,
+    'expansion_ratio': 1.2,
+}
+
+
+def classifier_thresholds(overrides=None):
+    """CLASSIFIER_THRESHOLDS with `overrides` applied; unknown names raise ValueError."""
+    thresholds = dict(CLASSIFIER_THRESHOLDS)
+    if overrides:
+        unknown = set(overrides) - set(thresholds)
+        if unknown:
+            raise ValueError(f'Unknown classifier thresholds: {sorted(unknown)}')
+        thresholds.update(overrides)
+    return thresholds
+
+
+def classify_previous_candle(df, engine='vectorized', body_pct_history=None, thresholds=None):
+    # compute rolling percentiles (20, min 10) on Body% in one rolling_quantiles pass and
+    # shift so percentiles represent values up to previous day when classifying "previous day".
+    # `body_pct_history` holds the body_pct_prev values of the rows preceding
+    # `df` (incremental runs), so the window sees the same values as a full run.
+    thresholds = classifier_thresholds(thresholds)
+    window = thresholds['body_window']
+    body_pct = df['body_pct_prev']
+    if body_pct_history is not None and len(body_pct_history):
+        history = pd.Series(body_pct_history, dtype=float)
+        body_pct = pd.concat([history, body_pct], ignore_index=True)
+    bands = rolling_quantiles(body_pct, window, [thresholds['body_high_q'], thresholds['body_low_q']],
+                              min_periods=window // 2)
+    shifted = np.full_like(bands, np.nan)
+    shifted[1:] = bands[:-1]
+    p70 = pd.Series(shifted[len(shifted) - len(df):, 0], index=df.index)
+    p30 = pd.Series(shifted[len(shifted) - len(df):, 1], index=df.index)
+
+    if engine == 'reference':
+        df['candle_state'] = _classify_previous_candle_loop(df, p70, p30)
+    else:
+        masks = _classify_previous_candle_vectorized(df, p70, p30, thresholds)
+        df['candle_state_mask'] = masks
+        df['candle_state'] = decode_tags(masks, 'candle_state')
+
+
+def open_context_masks(o, pdh, pdl, tc, bc, prev_range):
+    """Classify arrays of opens into open_context bitmasks (see TAG_FAMILIES)."""
+    o, pdh, pdl, tc, bc, prev_range = (np.asarray(x, dtype=float)
+                                       for x in (o, pdh, pdl, tc, bc, prev_range))
+    unknown = np.isnan(o) | np.isnan(pdh) | np.isnan(pdl)
+    pos = np.where(o > pdh, 0, np.where(o < pdl, 1, 2))
+
+    has_cpr = ~(np.isnan(tc) | np.isnan(bc))
+    cpr = np.where(o > tc, 0, np.where(o < bc, 1, 2))
+
+    # Quartile tags ONLY for inside previous range (dashboard-compatible)
+    inside = (o >= pdl) & (o <= pdh)
+    no_range = np.isnan(prev_range) | (prev_range == 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        top = (pdh - o) / prev_range < 0.25
+        bottom = (o - pdl) / prev_range < 0.25
+    quart = np.where(no_range, 2, np.where(top, 0, np.where(bottom, 1, 2)))
+
+    n_pos, n_cpr = len(OPEN_POSITIONS), len(CPR_POSITIONS)
+    masks = ((1 << pos)
+             | np.where(has_cpr, 1 << (n_pos + cpr), 0)
+             | np.where(inside, 1 << (n_pos + n_cpr + quart), 0))
+    masks = np.where(unknown, tag_mask('open_context', 'Unknown'), masks)
+    return masks.astype(np.uint16)
+
+
+def open_context_label(o, pdh, pdl, tc, bc, prev_range=None):
+    """Scalar entry point: open-context string for a single day (used by the dashboard)."""
+    if prev_range is None:
+        prev_range = pdh - pdl
+    masks = open_context_masks([o], [pdh], [pdl], [tc], [bc], [prev_range])
+    return decode_tags(masks, 'open_context')[0]
+
+
+def _classify_open_context_loop(df):
+    # Reference engine: row-by-row classification, kept for parity checks.
     ctxs = []
     for idx, row in df.iterrows():
         o = row['Open']
@@ -152,10 +435,30 @@ def classify_open_context(df):
 
         ctxs.append('|'.join(parts))
 
-    df['open_context'] = ctxs
+    return ctxs
 
 
-def label_next_day_outcomes(df):
+
+
+def classify_open_context(df, engine='vectorized'):
+    """
+    Classify open context relative to previous day's range and CPR.
+    
+    FIXED: Quartile tags (Open_Top_Quartile, Open_Bottom_Quartile, Open_Middle_Half)
+    are now ONLY appended if the open is INSIDE the previous day's range.
+    If open is outside the range (Above_PDH or Below_PDL), quartile tags are NOT added
+    to match dashboard-compatible strings.
+    """
+    if engine == 'reference':
+        df['open_context'] = _classify_open_context_loop(df)
+        return
+    masks = open_context_masks(df['Open'], df['PDH'], df['PDL'], df['TC'], df['BC'], df['prev_range'])
+    df['open_context_mask'] = masks
+    df['open_context'] = decode_tags(masks, 'open_context')
+
+
+def _label_next_day_outcomes_loop(df):
+    # Reference engine: row-by-row labelling, kept for parity checks.
     outcomes = []
     expansion_flags = []
     false_pdh = []
@@ -184,7 +487,9 @@ def label_next_day_outcomes(df):
             continue
 
         nrange = nh - nl
-        nbody_pct = safe_div(abs(nc - no), nrange)
+        # scalar division raises on zero: a flat next day has no body ratio and is a Range_Chop_Day,
+        # as in the vectorized engine
+        nbody_pct = abs(nc - no) / nrange if nrange != 0 else np.nan
         parts = []
         if not pd.isna(nbody_pct) and nbody_pct > 0.6 and (nc > no):
             parts.append('Trend_Up_Day')
@@ -230,30 +535,111 @@ def label_next_day_outcomes(df):
                 parts.append('Normal_Range_Day')
 
         outcomes.append('|'.join(parts))
-        next_range_pct.append(safe_div(nrange, prev_range))
+        next_range_pct.append(float(nrange / prev_range) if not pd.isna(prev_range) and prev_range != 0 else np.nan)
 
-    df['next_day_outcome'] = outcomes
-    df['expansion_flag'] = expansion_flags
-    df['false_pdh_break'] = false_pdh
-    df['false_pdl_break'] = false_pdl
-    df['pdh_break_success'] = pdh_success
-    df['pdl_break_success'] = pdl_success
-    df['next_range_pct'] = next_range_pct
+    return {
+        'next_day_outcome': outcomes,
+        'expansion_flag': expansion_flags,
+        'false_pdh_break': false_pdh,
+        'false_pdl_break': false_pdl,
+        'pdh_break_success': pdh_success,
+        'pdl_break_success': pdl_success,
+        'next_range_pct': next_range_pct,
+    }
 
 
-def gap_analysis(df):
-    """
-    Analyze gaps formed at today's open and same-day fills.
-    
-    Gap = Open - prev_close (calculated from today's data)
-    Fill probabilities measure whether the gap is filled during the same day's session.
+BREAK_FLAGS = ('false_pdh_break', 'false_pdl_break', 'pdh_break_success', 'pdl_break_success')
+OUTCOME_CLASS_COLUMNS = ('trend_up', 'trend_down', 'range_chop')
+
+
+def next_day_outcome_masks(df):
+    """next_day_outcome bitmasks built from the flag columns (0 where there is no next day)."""
+    trend = pd.Categorical(df['next_day_trend'], categories=NEXT_DAY_TRENDS).codes
+    masks = np.where(trend >= 0, 1 << np.maximum(trend, 0), 0).astype(np.uint16)
+    offset = len(NEXT_DAY_TRENDS)
+    for i, col in enumerate(BREAK_FLAGS):
+        masks |= df[col].to_numpy(dtype=bool).astype(np.uint16) << (offset + i)
+    offset += len(BREAK_TAGS)
+    prev_range = df['prev_range'].to_numpy(dtype=float)
+    expansion = df['expansion_flag'].to_numpy(dtype=object) == 'Expansion_Day'
+    # the range tag is only part of the string when prev_range is usable
+    has_range = (trend >= 0) & ~(np.isnan(prev_range) | (prev_range == 0))
+    range_bit = np.where(expansion, 1 << offset, 1 << (offset + 1))
+    return masks | np.where(has_range, range_bit, 0).astype(np.uint16)
+
+
+def compose_next_day_outcome(df):
+    """Build the composite '|'-joined next_day_outcome strings from the flag columns."""
+    return decode_tags(next_day_outcome_masks(df), 'next_day_outcome')
+
+
+def _add_outcome_classes(df):
+    # rows without a next day have code -1 and are False in every class
+    codes = df['next_day_trend'].cat.codes.to_numpy()
+    for i, col in enumerate(OUTCOME_CLASS_COLUMNS):
+        df[col] = codes == i
+
+
+def label_next_day_outcomes(df, engine='vectorized', composite=True, thresholds=None):
     """
-    # gap = Open - prev_close
-    gaps = df['Open'] - df['prev_close']
-    df['gap'] = gaps
-    df['gap_direction'] = np.where(gaps > 0, 'Gap_Up', np.where(gaps < 0, 'Gap_Down', 'No_Gap'))
-    df['gap_size_pct'] = safe_div(abs(gaps), df['prev_close'])
+    Label what happened on the next day as flag columns.
 
+    Writes next_day_trend (categorical), one boolean column per outcome class
+    (trend_up, trend_down, range_chop), expansion_flag, false_pdh_break,
+    false_pdl_break, pdh_break_success, pdl_break_success and next_range_pct.
+    The composite next_day_outcome string is only built when `composite` is true.
+    `thresholds` overrides trend_body/expansion_ratio (vectorized engine only).
+    """
+    if engine == 'reference':
+        for col, values in _label_next_day_outcomes_loop(df).items():
+            df[col] = values
+        trend = df['next_day_outcome'].str.split('|').str[0]
+        df['next_day_trend'] = pd.Categorical(trend, categories=NEXT_DAY_TRENDS)
+        _add_outcome_classes(df)
+        return
+
+    thresholds = classifier_thresholds(thresholds)
+    nh = df['next_high'].to_numpy(dtype=float)
+    nl = df['next_low'].to_numpy(dtype=float)
+    nc = df['next_close'].to_numpy(dtype=float)
+    no = df['next_open'].to_numpy(dtype=float)
+    prev_range = df['prev_range'].to_numpy(dtype=float)
+    pdh = df['PDH'].to_numpy(dtype=float)
+    pdl = df['PDL'].to_numpy(dtype=float)
+
+    has_next = ~(np.isnan(nh) | np.isnan(nl) | np.isnan(nc) | np.isnan(no))
+    nrange = nh - nl
+    nbody_pct = safe_div(np.abs(nc - no), nrange)
+    trend_day = nbody_pct > thresholds['trend_body']
+    trend = np.select([trend_day & (nc > no), trend_day & (nc < no)],
+                      [NEXT_DAY_TRENDS[0], NEXT_DAY_TRENDS[1]], default=NEXT_DAY_TRENDS[2]).astype(object)
+    trend[~has_next] = np.nan
+
+    has_range = ~(np.isnan(prev_range) | (prev_range == 0))
+    expansion = np.where(has_range & (nrange > prev_range * thresholds['expansion_ratio']), 'Expansion_Day', 'Normal_Range_Day').astype(object)
+    expansion[~has_next] = np.nan
+
+    df['next_day_trend'] = pd.Categorical(trend, categories=NEXT_DAY_TRENDS)
+    _add_outcome_classes(df)
+    df['expansion_flag'] = expansion
+    df['false_pdh_break'] = has_next & (nh > pdh) & (nc < pdh)
+    df['false_pdl_break'] = has_next & (nl < pdl) & (nc > pdl)
+    df['pdh_break_success'] = has_next & (nh > pdh) & (nc >= pdh)
+    df['pdl_break_success'] = has_next & (nl < pdl) & (nc <= pdl)
+    df['next_range_pct'] = np.where(has_next, safe_div(nrange, prev_range), np.nan)
+    if composite:
+        df['next_day_outcome'] = compose_next_day_outcome(df)
+
+
+GAP_FILL_FRACTIONS = (0.5, 0.8, 1.0)
+
+
+def gap_fill_column(fraction):
+    return f'fill_{fraction * 100:g}pct'
+
+
+def _gap_fills_loop(df):
+    # Reference engine: row-by-row fills for the default fractions, kept for parity checks.
     fill50 = []
     fill80 = []
     fill100 = []
@@ -272,36 +658,114 @@ def gap_analysis(df):
         if g > 0:
             # Gap Up: filled if Low <= prev_close (same-day fill)
             fill100.append(low <= prev_close)
-            fill80.append(low <= (prev_close + 0.8 * g))
-            fill50.append(low <= (prev_close + 0.5 * g))
+            fill80.append(low <= (prev_close + (1 - 0.8) * g))
+            fill50.append(low <= (prev_close + (1 - 0.5) * g))
         elif g < 0:
             # Gap Down: filled if High >= prev_close (same-day fill)
             ag = abs(g)
             fill100.append(high >= prev_close)
-            fill80.append(high >= (prev_close - 0.8 * ag))
-            fill50.append(high >= (prev_close - 0.5 * ag))
+            fill80.append(high >= (prev_close - (1 - 0.8) * ag))
+            fill50.append(high >= (prev_close - (1 - 0.5) * ag))
         else:
             fill50.append(False)
             fill80.append(False)
             fill100.append(False)
 
-    df['fill_50pct'] = fill50
-    df['fill_80pct'] = fill80
-    df['fill_100pct'] = fill100
+    return {'fill_50pct': fill50, 'fill_80pct': fill80, 'fill_100pct': fill100}
 
 
-def compute_level_game_stats(df, outdir):
+def gap_fills(gap, prev_close, high, low, fractions=GAP_FILL_FRACTIONS):
     """
-    Compute detailed scenario data for the Level Game.
-    
-    For each key level (PDH, PDL, TC, BC), track:
-    - FirstTouch: Whether the level was touched during the day
-    - Broken: Whether the level was broken from the open side
-    - AfterBreakRetouch: If broken, whether price retouched the level after breaking
-    - BreakSuccess: If broken, whether the close was beyond the level (confirming break)
+    Boolean (rows x fractions) matrix of same-day gap fills.
+
+    A fill of fraction f means price retraced f of the gap back towards the
+    previous close, i.e. traded through prev_close + (1 - f) * gap.
+    """
+    g = np.asarray(gap, dtype=float)[:, None]
+    pc = np.asarray(prev_close, dtype=float)[:, None]
+    target = pc + (1 - np.asarray(fractions, dtype=float))[None, :] * g
+    up_fill = (g > 0) & (np.asarray(low, dtype=float)[:, None] <= target)
+    down_fill = (g < 0) & (np.asarray(high, dtype=float)[:, None] >= target)
+    return up_fill | down_fill
+
+
+def gap_analysis(df, fill_fractions=GAP_FILL_FRACTIONS, engine='vectorized'):
+    """
+    Analyze gaps formed at today's open and same-day fills.
     
-    Output: level_game_stats.csv
+    Gap = Open - prev_close (calculated from today's data)
+    Fill probabilities measure whether the gap is filled during the same day's session.
+    One fill_<N>pct column is written per entry in `fill_fractions`.
     """
+    # gap = Open - prev_close
+    gaps = df['Open'] - df['prev_close']
+    df['gap'] = gaps
+    df['gap_direction'] = np.where(gaps > 0, 'Gap_Up', np.where(gaps < 0, 'Gap_Down', 'No_Gap'))
+    df['gap_size_pct'] = safe_div(abs(gaps), df['prev_close'])
+
+    if engine == 'reference':
+        if tuple(fill_fractions) != GAP_FILL_FRACTIONS:
+            raise ValueError('reference engine only supports the default gap fill fractions')
+        for col, values in _gap_fills_loop(df).items():
+            df[col] = values
+        return
+
+    filled = gap_fills(gaps, df['prev_close'], df['High'], df['Low'], fill_fractions)
+    for i, fraction in enumerate(fill_fractions):
+        df[gap_fill_column(fraction)] = filled[:, i]
+
+
+def previous_period_extreme(df, column, freq, how):
+    """Each day's value of the previous calendar period's max/min of `column` (e.g. previous-week high)."""
+    if not pd.api.types.is_datetime64_any_dtype(df['Date']):
+        return pd.Series(np.nan, index=df.index)
+    period = df['Date'].dt.to_period(freq)
+    per_period = df.groupby(period)[column].agg(how)
+    return period.map(per_period.shift(1)).astype(float)
+
+
+# Level registry: name -> vectorized expression over the enriched frame.
+# Floor pivots R1/R2/S1/S2 use the same previous-day PP as the CPR.
+LEVEL_DEFINITIONS = {
+    'PDH': lambda df: df['PDH'],
+    'PDL': lambda df: df['PDL'],
+    'TC': lambda df: df['TC'],
+    'BC': lambda df: df['BC'],
+    'PP': lambda df: df['PP'],
+    'R1': lambda df: 2 * df['PP'] - df['PDL'],
+    'S1': lambda df: 2 * df['PP'] - df['PDH'],
+    'R2': lambda df: df['PP'] + (df['PDH'] - df['PDL']),
+    'S2': lambda df: df['PP'] - (df['PDH'] - df['PDL']),
+    'PWH': lambda df: previous_period_extreme(df, 'High', 'W', 'max'),
+    'PWL': lambda df: previous_period_extreme(df, 'Low', 'W', 'min'),
+    'PMH': lambda df: previous_period_extreme(df, 'High', 'M', 'max'),
+    'PML': lambda df: previous_period_extreme(df, 'Low', 'M', 'min'),
+}
+
+
+def register_level(name, expression):
+    """Add a level to the registry; `expression(df)` must return one value per row."""
+    LEVEL_DEFINITIONS[name] = expression
+
+
+def level_matrix(df, levels):
+    """Evaluate the named levels into a (rows x levels) float matrix."""
+    unknown = [name for name in levels if name not in LEVEL_DEFINITIONS]
+    if unknown:
+        raise ValueError(f'Unknown levels {unknown}; registered: {sorted(LEVEL_DEFINITIONS)}')
+    out = np.empty((len(df), len(levels)), dtype=float)
+    for i, name in enumerate(levels):
+        out[:, i] = np.asarray(LEVEL_DEFINITIONS[name](df), dtype=float)
+    return out
+
+
+LEVEL_GAME_LEVELS = ('PDH', 'PDL', 'TC', 'BC')
+LEVEL_GAME_FLAGS = ('FirstTouch', 'Broken', 'BrokenDirection', 'AfterBreakRetouch', 'BreakSuccess')
+
+
+def _level_game_loop(df):
+    # Reference engine: one dict per day per level in the original long
+    # (level_game_stats.csv) schema, kept for parity checks.
     stats = []
     
     for idx, row in df.iterrows():
@@ -372,25 +836,278 @@ def compute_level_game_stats(df, outdir):
                 'BreakSuccess': break_success if broken else None,
             })
 
-    level_df = pd.DataFrame(stats)
-    level_df.to_csv(os.path.join(outdir, 'level_game_stats.csv'), index=False)
+    return pd.DataFrame(stats)
 
 
-def aggregate_and_write(df, outdir):
-    os.makedirs(outdir, exist_ok=True)
+def level_game_daily(df, levels=LEVEL_GAME_LEVELS):
+    """
+    Evaluate the Level Game for every (day, level) pair at once.
 
+    `levels` are names from LEVEL_DEFINITIONS.
+    Returns one row per day with Date, OHLC, the level values and a
+    <Flag>_<Level> column for each of LEVEL_GAME_FLAGS. Cells are empty where
+    the level is missing, and the after-break flags are empty when the level
+    was not broken. Days without usable OHLC or levels are dropped.
+    """
+    ohlc = df[['Open', 'High', 'Low', 'Close']].to_numpy(dtype=float)
+    lv = level_matrix(df, levels)
+    o, h, l, c = (ohlc[:, i:i + 1] for i in range(4))
+
+    valid = ~np.isnan(lv) & ~np.isnan(ohlc).any(axis=1, keepdims=True)
+    keep = valid.any(axis=1)
+    valid, lv = valid[keep], lv[keep]
+    o, h, l, c = o[keep], h[keep], l[keep], c[keep]
+
+    # FirstTouch: level was touched during the day (high >= lvl and low <= lvl)
+    first_touch = (h >= lv) & (l <= lv)
+    # Broken: level was crossed from the open side
+    from_below = o < lv
+    from_above = o > lv
+    broken = (from_below & (h > lv)) | (from_above & (l < lv))
+    # AfterBreakRetouch / BreakSuccess only defined once the level broke
+    retouch = (from_below & (c < lv)) | (from_above & (c > lv))
+    success = (from_below & (c >= lv)) | (from_above & (c <= lv))
+    direction = np.where(from_below, 'Up', np.where(from_above, 'Down', None)).astype(object)
+    direction[~valid] = None
+
+    daily = df.loc[keep, ['Date', 'Open', 'High', 'Low', 'Close']].reset_index(drop=True)
+    for i, name in enumerate(levels):
+        daily[name] = lv[:, i]
+    flags = {
+        'FirstTouch': pd.arrays.BooleanArray(first_touch, ~valid),
+        'Broken': pd.arrays.BooleanArray(broken, ~valid),
+        'BrokenDirection': direction,
+        'AfterBreakRetouch': pd.arrays.BooleanArray(retouch, ~(valid & broken)),
+        'BreakSuccess': pd.arrays.BooleanArray(success, ~(valid & broken)),
+    }
+    cols = {}
+    for flag in LEVEL_GAME_FLAGS:
+        for i, name in enumerate(levels):
+            cols[f'{flag}_{name}'] = flags[flag][:, i]
+    return pd.concat([daily, pd.DataFrame(cols)], axis=1)
+
+
+def level_game_long(daily, levels=LEVEL_GAME_LEVELS):
+    """Expand a level_game_daily() table back into the long one-row-per-level schema."""
+    frames = []
+    for name in levels:
+        part = daily[['Date']].copy()
+        part['Level'] = name
+        part['LevelValue'] = daily[name]
+        for col in ['Open', 'High', 'Low', 'Close']:
+            part[col] = daily[col]
+        for flag in LEVEL_GAME_FLAGS:
+            part[flag] = daily[f'{flag}_{name}']
+        part['_day'] = np.arange(len(daily))
+        part['_lvl'] = levels.index(name)
+        frames.append(part[part['LevelValue'].notna()])
+    long_df = pd.concat(frames).sort_values(['_day', '_lvl'], kind='stable')
+    return long_df.drop(columns=['_day', '_lvl']).reset_index(drop=True)
+
+
+def check_level_game_parity(df):
+    """Compare the matrix engine with the reference loop, as CSV text, on the default levels."""
+    ref = _level_game_loop(df).to_csv(index=False)
+    ours = level_game_long(level_game_daily(df)).to_csv(index=False)
+    if ref == ours:
+        return []
+    diff = sum(1 for x, y in zip(ref.splitlines(), ours.splitlines()) if x != y)
+    return [('level_game', diff + abs(ref.count('\n') - ours.count('\n')))]
+
+
+def compute_level_game_stats(df, outdir, engine='vectorized', levels=LEVEL_GAME_LEVELS):
+    """
+    Compute detailed scenario data for the Level Game.
+    
+    For each level in `levels` (default PDH, PDL, TC, BC), track:
+    - FirstTouch: Whether the level was touched during the day
+    - Broken: Whether the level was broken from the open side
+    - AfterBreakRetouch: If broken, whether price retouched the level after breaking
+    - BreakSuccess: If broken, whether the close was beyond the level (confirming break)
+    
+    Output: level_game_daily.csv (one row per day, one column per flag and level).
+    Returns the daily table.
+    """
+    if engine == 'reference':
+        if tuple(levels) != LEVEL_GAME_LEVELS:
+            raise ValueError('reference engine only supports the default PDH/PDL/TC/BC levels')
+        long_df = _level_game_loop(df)
+        daily = long_df.pivot(index='Date', columns='Level', values=list(LEVEL_GAME_FLAGS))
+        daily.columns = [f'{flag}_{lvl}' for flag, lvl in daily.columns]
+        values = long_df.pivot(index='Date', columns='Level', values='LevelValue')
+        ohlc = long_df.groupby('Date')[['Open', 'High', 'Low', 'Close']].first()
+        daily = pd.concat([ohlc, values[list(LEVEL_GAME_LEVELS)], daily], axis=1).reset_index()
+        daily = daily[['Date', 'Open', 'High', 'Low', 'Close'] + list(LEVEL_GAME_LEVELS)
+                      + [f'{flag}_{lvl}' for flag in LEVEL_GAME_FLAGS for lvl in LEVEL_GAME_LEVELS]]
+    else:
+        daily = level_game_daily(df, levels)
+    daily.to_csv(os.path.join(outdir, 'level_game_daily.csv'), index=False)
+    return daily
+
+
+# Level Game scenarios, declared as data. Each condition name maps to either
+# (column, op, column) comparing two numeric columns of a level_game_daily() table or
+# (column, '==', value) testing a flag/direction column. Comparisons involving a
+# missing level are False, as is every condition on a column the table lacks.
+SCENARIO_CONDITIONS = {
+    'open_below_bc': ('Open', '<', 'BC'),
+    'open_above_tc': ('Open', '>', 'TC'),
+    'open_at_or_above_bc': ('Open', '>=', 'BC'),
+    'open_at_or_below_tc': ('Open', '<=', 'TC'),
+    'high_above_tc': ('High', '>', 'TC'),
+    'high_above_pdh': ('High', '>', 'PDH'),
+    'low_below_pdl': ('Low', '<', 'PDL'),
+    'close_above_tc': ('Close', '>', 'TC'),
+    'close_below_bc': ('Close', '<', 'BC'),
+    'close_at_or_above_bc': ('Close', '>=', 'BC'),
+    'close_at_or_below_tc': ('Close', '<=', 'TC'),
+    'close_above_pdh': ('Close', '>', 'PDH'),
+    'close_below_pdh': ('Close', '<', 'PDH'),
+    'close_above_pdl': ('Close', '>', 'PDL'),
+    'close_below_pdl': ('Close', '<', 'PDL'),
+    'touched_bc': ('FirstTouch_BC', '==', True),
+    'touched_tc': ('FirstTouch_TC', '==', True),
+    'touched_pdh': ('FirstTouch_PDH', '==', True),
+    'touched_pdl': ('FirstTouch_PDL', '==', True),
+    'broke_tc': ('Broken_TC', '==', True),
+    'broke_bc': ('Broken_BC', '==', True),
+    'broke_pdl': ('Broken_PDL', '==', True),
+    'tc_from_below': ('BrokenDirection_TC', '==', 'Up'),
+    'bc_from_above': ('BrokenDirection_BC', '==', 'Down'),
+    'pdl_from_above': ('BrokenDirection_PDL', '==', 'Down'),
+}
+
+# (scenario, condition, [(outcome, condition), ...]); a condition is a tuple of
+# SCENARIO_CONDITIONS names that must all hold, '~name' negating one. Gap
+# scenarios live in gap_stats.csv and are shown by the Gap Game instead.
+LEVEL_SCENARIOS = (
+    ('Open below BC', ('open_below_bc',),
+     [('Touched BC', ('touched_bc',)),
+      ('Never touched BC', ('~touched_bc',))]),
+    ('Open below BC & Touched BC', ('open_below_bc', 'touched_bc'),
+     [('Breaks TC', ('broke_tc', 'tc_from_below')),
+      ('Closes below BC', ('close_below_bc',))]),
+    ('Open below BC & No touch BC', ('open_below_bc', '~touched_bc'),
+     [('Breaks Prev Low', ('broke_pdl', 'pdl_from_above'))]),
+    ('Open above TC', ('open_above_tc',),
+     [('Touched TC', ('touched_tc',)),
+      ('Never touched TC', ('~touched_tc',))]),
+    ('Open above TC & Touched TC', ('open_above_tc', 'touched_tc'),
+     [('Breaks BC', ('broke_bc', 'bc_from_above')),
+      ('Closes above TC', ('close_above_tc',))]),
+    ('Open inside CPR', ('open_at_or_above_bc', 'open_at_or_below_tc'),
+     [('Closes above TC', ('close_above_tc',)),
+      ('Closes below BC', ('close_below_bc',)),
+      ('Closes within CPR', ('close_at_or_above_bc', 'close_at_or_below_tc'))]),
+    ('Touched Prev Day High', ('touched_pdh',),
+     [('Rejection at PDH', ('high_above_pdh', 'close_below_pdh')),
+      ('Strong breakout above PDH', ('high_above_pdh', 'close_above_pdh'))]),
+    ('Touched Prev Day Low', ('touched_pdl',),
+     [('Bounce from PDL', ('low_below_pdl', 'close_above_pdl')),
+      ('Strong breakdown below PDL', ('low_below_pdl', 'close_below_pdl'))]),
+    ('Breaks TC from below', ('open_below_bc', 'high_above_tc'),
+     [('Closes above TC', ('close_above_tc',)),
+      ('Closes below BC', ('close_below_bc',))]),
+)
+
+_COMPARISONS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+
+def condition_mask(daily, condition, cache):
+    """
+    Boolean mask of a condition over the per-day table: a SCENARIO_CONDITIONS
+    name, '~name', or a tuple of those that must all hold. Every name and
+    tuple is evaluated once per table and kept in `cache`, so conditions
+    shared between scenarios and outcomes cost nothing the second time.
+    """
+    if condition in cache:
+        return cache[condition]
+    if isinstance(condition, tuple):
+        mask = np.ones(len(daily), dtype=bool)
+        for name in condition:
+            mask = mask & condition_mask(daily, name, cache)
+    elif condition.startswith('~'):
+        mask = ~condition_mask(daily, condition[1:], cache)
+    else:
+        left, op, right = SCENARIO_CONDITIONS[condition]
+        if left not in daily.columns or (op != '==' and right not in daily.columns):
+            mask = np.zeros(len(daily), dtype=bool)
+        elif op == '==':
+            # flags are nullable booleans in memory and True/False/NaN read back from CSV
+            mask = daily[left].eq(right).fillna(False).to_numpy(dtype=bool)
+        else:
+            with np.errstate(invalid='ignore'):
+                mask = _COMPARISONS[op](daily[left].to_numpy(dtype=float), daily[right].to_numpy(dtype=float))
+    cache[condition] = mask
+    return mask
+
+
+def level_scenario_counts(daily, scenarios=LEVEL_SCENARIOS):
+    """
+    Days matching each scenario and each of its outcomes, indexed by
+    (scenario, outcome) with total_count and outcome_count columns. Counts
+    are additive, so incremental runs keep them as running counters.
+    """
+    cache = {}
+    rows = {}
+    for scenario, condition, outcomes in scenarios:
+        mask = condition_mask(daily, condition, cache)
+        for outcome, outcome_condition in outcomes:
+            rows[(scenario, outcome)] = (int(mask.sum()),
+                                         int((mask & condition_mask(daily, outcome_condition, cache)).sum()))
+    index = pd.MultiIndex.from_tuples(list(rows), names=['scenario', 'outcome'])
+    return pd.DataFrame(list(rows.values()), index=index, columns=['total_count', 'outcome_count'])
+
+
+def level_scenario_stats(counts, scenarios=LEVEL_SCENARIOS):
+    """Scenario table from level_scenario_counts(): scenario, outcome, total_count, outcome_count, probability."""
+    order = [(scenario, outcome) for scenario, _, outcomes in scenarios for outcome, _ in outcomes]
+    stats = counts.reindex(order, fill_value=0).astype(int).reset_index()
+    stats = stats[stats['total_count'] > 0].reset_index(drop=True)  # scenarios no day matched are left out
+    stats['probability'] = stats['outcome_count'] / stats['total_count']
+    return stats
+
+
+def compute_level_scenario_stats(level_daily, scenarios=LEVEL_SCENARIOS):
+    """
+    Aggregate a per-day Level Game table (one row per day, <Flag>_<Level> columns) into the scenario table
+    shown by the dashboard: scenario, outcome, total_count, outcome_count, probability.
+    """
+    return level_scenario_stats(level_scenario_counts(level_daily, scenarios), scenarios)
+
+
+def scenario_level_daily(df, levels, level_daily=None):
+    """
+    The per-day Level Game table LEVEL_SCENARIOS are evaluated on: `level_daily`
+    (df's table for `levels`) when `levels` are the default PDH/PDL/TC/BC,
+    else one recomputed for them, since the scenarios need exactly those
+    levels whatever --levels selects.
+    """
+    if level_daily is not None and tuple(levels) == LEVEL_GAME_LEVELS:
+        return level_daily
+    return level_game_daily(df, LEVEL_GAME_LEVELS)
+
+
+def write_level_scenario_stats(level_daily, outdir):
+    """Write level_scenario_stats.csv for a per-day Level Game table and return it."""
+    stats = compute_level_scenario_stats(level_daily)
+    stats.to_csv(os.path.join(outdir, 'level_scenario_stats.csv'), index=False)
+    return stats
+
+
+def _candle_open_stats_contains(df):
+    # Reference engine: substring-match the composite next_day_outcome per group.
     # Candle state stats
-    cs = df[~df['candle_state'].isna()].groupby('candle_state')
+    cs = df[~df['candle_state'].isna()].groupby('candle_state', observed=True)
     candle_stats = cs.agg(total_count=('candle_state', 'size'),
                           prob_trend_up=('next_day_outcome', lambda s: s.str.contains('Trend_Up_Day').sum() / len(s)),
                           prob_trend_down=('next_day_outcome', lambda s: s.str.contains('Trend_Down_Day').sum() / len(s)),
                           prob_range_chop=('next_day_outcome', lambda s: s.str.contains('Range_Chop_Day').sum() / len(s)),
                           avg_next_day_range_pct=('next_range_pct', 'mean'))
     candle_stats = candle_stats.reset_index()
-    candle_stats.to_csv(os.path.join(outdir, 'candle_state_stats.csv'), index=False)
 
     # Open context stats
-    oc = df[~df['open_context'].isna()].groupby('open_context')
+    oc = df[~df['open_context'].isna()].groupby('open_context', observed=True)
     open_stats = oc.agg(total_count=('open_context', 'size'),
                         prob_trend_up=('next_day_outcome', lambda s: s.str.contains('Trend_Up_Day').sum() / len(s)),
                         prob_trend_down=('next_day_outcome', lambda s: s.str.contains('Trend_Down_Day').sum() / len(s)),
@@ -404,73 +1121,499 @@ def aggregate_and_write(df, outdir):
     open_stats = open_stats.reset_index()
     for col in ['prob_pdh_break_success', 'prob_pdl_break_success', 'prob_false_pdh_break', 'prob_false_pdl_break']:
         open_stats[col] = open_stats[col] / open_stats['total_count']
-    open_stats.to_csv(os.path.join(outdir, 'open_context_stats.csv'), index=False)
+    return candle_stats, open_stats
 
-    # Gap stats with buckets
-    df_gap = df[~df['gap_direction'].isna()].copy()
-    # bucket: 0-0.5%, 0.5-1%, 1-2%, >2% (percent of previous range)
-    pct = df_gap['gap_size_pct'] * 100
-    bins = [0, 0.5, 1.0, 2.0, 1e9]
-    labels = ['0-0.5%', '0.5-1%', '1-2%', '>2%']
-    df_gap['gap_bucket'] = pd.cut(pct.fillna(-1), bins=bins, labels=labels, include_lowest=True)
+
+def _stats_by_tags(df, family, **aggs):
+    # Group on the integer bitmask instead of the label strings, then decode the
+    # (small) result back to strings in the same sorted order as before.
+    col = family + '_mask'
+    masks = df[col].to_numpy() if col in df.columns else encode_tags(df[family], family)
+    stats = df.groupby(masks).agg(**aggs)
+    stats = stats[stats.index != 0]  # mask 0 marks a missing label
+    stats.insert(0, family, decode_tags(stats.index, family))
+    return stats.sort_values(family).reset_index(drop=True)
+
+
+def candle_open_stats(df):
+    """Candle-state and open-context tables from the boolean outcome columns."""
+    prob_trend = {'prob_' + col: (col, 'mean') for col in OUTCOME_CLASS_COLUMNS}
+
+    # Candle state stats
+    candle_stats = _stats_by_tags(df, 'candle_state',
+                                  total_count=('next_range_pct', 'size'),
+                                  **prob_trend,
+                                  avg_next_day_range_pct=('next_range_pct', 'mean'))
+
+    # Open context stats
+    open_stats = _stats_by_tags(df, 'open_context',
+                                total_count=('next_range_pct', 'size'),
+                                **prob_trend,
+                                prob_pdh_break_success=('pdh_break_success', 'mean'),
+                                prob_pdl_break_success=('pdl_break_success', 'mean'),
+                                prob_false_pdh_break=('false_pdh_break', 'mean'),
+                                prob_false_pdl_break=('false_pdl_break', 'mean'),
+                                avg_next_day_range_pct=('next_range_pct', 'mean'))
+    return candle_stats, open_stats
+
+
+def gap_bucket_labels(edges):
+    """'lo-hi%' labels for consecutive bucket edges, '>lo%' for the open-ended last one."""
+    labels = [f'{lo:g}-{hi:g}%' for lo, hi in zip(edges[:-2], edges[1:-1])]
+    return tuple(labels + [f'>{edges[-2]:g}%'])
+
+
+# bucket: 0-0.5%, 0.5-1%, 1-2%, >2% (percent of previous close)
+GAP_BUCKET_EDGES = (0, 0.5, 1.0, 2.0, 1e9)
+GAP_BUCKET_LABELS = gap_bucket_labels(GAP_BUCKET_EDGES)
+
+
+def gap_buckets(gap_size_pct, edges=GAP_BUCKET_EDGES):
+    """Categorical gap bucket per row; NaN where the gap size is unknown."""
+    pct = pd.Series(gap_size_pct) * 100
+    return pd.cut(pct.fillna(-1), bins=list(edges), labels=list(gap_bucket_labels(edges)),
+                  include_lowest=True)
+
+
+def gap_frame(df, fill_fractions=GAP_FILL_FRACTIONS, edges=GAP_BUCKET_EDGES):
+    """Rows with a known gap bucket, reduced to the columns the gap table aggregates."""
+    fill_cols = [gap_fill_column(f) for f in fill_fractions]
+    df_gap = df.loc[~df['gap_direction'].isna(), ['gap_direction', 'gap', 'gap_size_pct'] + fill_cols].copy()
+    df_gap['gap_bucket'] = gap_buckets(df_gap['gap_size_pct'], edges)
     # Exclude NaNs (no previous range)
     df_gap = df_gap[~df_gap['gap_bucket'].isna()]
+    if isinstance(df_gap['gap_direction'].dtype, pd.CategoricalDtype):
+        # --lean frames: keep the per-bucket grid to the directions present, as with strings
+        df_gap = df_gap.assign(gap_direction=df_gap['gap_direction'].cat.remove_unused_categories())
+    return df_gap
+
 
-    gg = df_gap.groupby(['gap_direction', 'gap_bucket'])
+def gap_stats_table(df_gap, fill_fractions=GAP_FILL_FRACTIONS):
+    """Day count, fill probabilities and mean gap size per (gap_direction, gap_bucket) of a `gap_frame`."""
+    gg = df_gap.groupby(['gap_direction', 'gap_bucket'], observed=False)
+    fill_aggs = {'prob_' + gap_fill_column(f): (gap_fill_column(f), 'mean') for f in fill_fractions}
     gap_stats = gg.agg(total_count=('gap', 'size'),
-                       prob_fill_50pct=('fill_50pct', 'mean'),
-                       prob_fill_80pct=('fill_80pct', 'mean'),
-                       prob_fill_100pct=('fill_100pct', 'mean'),
+                       **fill_aggs,
                        avg_gap_size_pct=('gap_size_pct', 'mean'))
-    gap_stats = gap_stats.reset_index()
+    return gap_stats.reset_index()
+
+
+def aggregate_and_write(df, outdir, fill_fractions=GAP_FILL_FRACTIONS, engine='vectorized'):
+    os.makedirs(outdir, exist_ok=True)
+
+    if engine == 'reference':
+        candle_stats, open_stats = _candle_open_stats_contains(df)
+    else:
+        candle_stats, open_stats = candle_open_stats(df)
+    candle_stats.to_csv(os.path.join(outdir, 'candle_state_stats.csv'), index=False)
+    open_stats.to_csv(os.path.join(outdir, 'open_context_stats.csv'), index=False)
+
+    # Gap stats with buckets
+    gap_stats = gap_stats_table(gap_frame(df, fill_fractions), fill_fractions)
     gap_stats.to_csv(os.path.join(outdir, 'gap_stats.csv'), index=False)
     
     # write global thresholds (overall percentiles for body_pct_prev)
-    try:
-        body_series = df['body_pct_prev'].dropna()
-        body_70 = float(np.nanpercentile(body_series, 70)) if len(body_series) > 0 else None
-        body_30 = float(np.nanpercentile(body_series, 30)) if len(body_series) > 0 else None
-        import json
-        thresholds = {'body_70': body_70, 'body_30': body_30}
-        with open(os.path.join(outdir, 'thresholds.json'), 'w') as f:
-            json.dump(thresholds, f)
-    except Exception:
-        pass
+    write_thresholds(df['body_pct_prev'].dropna().to_numpy(), outdir)
 
+    return candle_stats, open_stats, gap_stats
 
-def load_data(input_path: str, header_idx: int = 2) -> pd.DataFrame:
-    """Load Excel/CSV using header at zero-based `header_idx`.
 
-    By default `header_idx=2` (i.e. header on Excel row 3, data from row 4).
+def write_thresholds(body_pcts, outdir):
+    body_70 = float(np.percentile(body_pcts, 70)) if len(body_pcts) > 0 else None
+    body_30 = float(np.percentile(body_pcts, 30)) if len(body_pcts) > 0 else None
+    thresholds = {'body_70': body_70, 'body_30': body_30}
+    with open(os.path.join(outdir, 'thresholds.json'), 'w') as f:
+        json.dump(thresholds, f)
+
+
+# An outcome of row i is day i+1, so at day t's open (when row t is classified)
+# only rows up to t-2 have a realized outcome.
+WALK_FORWARD_LAG = 2
+CALIBRATION_BINS = 10
+
+
+def _prior_group_sums(keys, values, lag=WALK_FORWARD_LAG):
+    # For every row t: column sums of `values` over rows i <= t - lag with
+    # keys[i] == keys[t]. Inclusive per-group cumulative sums, minus the last
+    # `lag` rows when they share the key, keep the whole pass O(n * lag).
+    values = np.asarray(values, dtype=float)
+    out = pd.DataFrame(values).groupby(keys).cumsum().to_numpy()
+    for k in range(lag):
+        same = np.zeros(len(keys), dtype=bool)
+        same[k:] = keys[k:] == keys[:len(keys) - k]
+        shifted = np.zeros_like(values)
+        shifted[k:] = values[:len(values) - k]
+        out -= shifted * same[:, None]
+    return out
+
+
+def walk_forward_probabilities(df, family, lag=WALK_FORWARD_LAG):
     """
-    if input_path.lower().endswith('.xlsx') or input_path.lower().endswith('.xls'):
-        df = pd.read_excel(input_path, header=header_idx)
-    else:
-        df = pd.read_csv(input_path, header=header_idx)
-    # normalize column names
-    df.columns = df.columns.astype(str).str.strip()
-    return df
+    Per row, the `family` group's outcome-class probabilities using only rows
+    whose next day was already over (i <= t - lag): prior_count plus one
+    prob_<class> column per OUTCOME_CLASS_COLUMNS entry.
+    """
+    col = family + '_mask'
+    keys = df[col].to_numpy() if col in df.columns else encode_tags(df[family], family)
+    classes = df[list(OUTCOME_CLASS_COLUMNS)].to_numpy(dtype=float)
+    realized = df['next_day_trend'].notna().to_numpy()
+    # rows without a next day never become part of the history
+    sums = _prior_group_sums(keys, np.column_stack([realized, classes * realized[:, None]]), lag)
+    out = pd.DataFrame({'prior_count': sums[:, 0].astype(int)}, index=df.index)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i, name in enumerate(OUTCOME_CLASS_COLUMNS):
+            out['prob_' + name] = sums[:, i + 1] / sums[:, 0]
+    out[keys == 0] = np.nan  # no label, nothing to look up
+    return out
+
+
+def walk_forward(df, outdir, min_count=20, lag=WALK_FORWARD_LAG):
+    """
+    Score out-of-sample candle-state and open-context probabilities.
+
+    For every row with a realized next day and at least `min_count` prior
+    days in its group, the walk-forward probabilities are scored against the
+    realized class: hit rate of the most likely class, multi-class Brier
+    score, and the Brier score of the unconditional prior class rates as a
+    baseline. Writes walk_forward_daily.csv, walk_forward_scores.csv and
+    walk_forward_calibration.csv; returns the scores table.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    classes = df[list(OUTCOME_CLASS_COLUMNS)].to_numpy(dtype=float)
+    realized = df['next_day_trend'].notna().to_numpy()
+    baseline = _prior_group_sums(np.zeros(len(df), dtype=np.int8),
+                                 np.column_stack([realized, classes * realized[:, None]]), lag)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        baseline = baseline[:, 1:] / baseline[:, :1]
+
+    daily = pd.DataFrame({'Date': df['Date'], 'next_day_trend': df['next_day_trend']})
+    scores, calibration = [], []
+    for family in ('candle_state', 'open_context'):
+        probs = walk_forward_probabilities(df, family, lag)
+        daily[family] = df[family]
+        daily[family + '_prior_count'] = probs['prior_count']
+        for name in OUTCOME_CLASS_COLUMNS:
+            daily[f'{family}_prob_{name}'] = probs['prob_' + name]
+
+        p = probs[['prob_' + name for name in OUTCOME_CLASS_COLUMNS]].to_numpy()
+        scored = realized & (probs['prior_count'].to_numpy() >= min_count) & ~np.isnan(p).any(axis=1)
+        p, y, base = p[scored], classes[scored], baseline[scored]
+        scores.append({
+            'family': family,
+            'rows_scored': int(scored.sum()),
+            'hit_rate': float((p.argmax(axis=1) == y.argmax(axis=1)).mean()) if len(p) else np.nan,
+            'brier': float(((p - y) ** 2).sum(axis=1).mean()) if len(p) else np.nan,
+            'baseline_brier': float(((base - y) ** 2).sum(axis=1).mean()) if len(p) else np.nan,
+        })
+        bins = np.clip((p * CALIBRATION_BINS).astype(int), 0, CALIBRATION_BINS - 1)
+        for i, name in enumerate(OUTCOME_CLASS_COLUMNS):
+            for b in range(CALIBRATION_BINS):
+                in_bin = bins[:, i] == b
+                calibration.append({
+                    'family': family,
+                    'outcome': name,
+                    'bucket': f'{b / CALIBRATION_BINS:g}-{(b + 1) / CALIBRATION_BINS:g}',
+                    'count': int(in_bin.sum()),
+                    'mean_predicted': float(p[in_bin, i].mean()) if in_bin.any() else np.nan,
+                    'realized_rate': float(y[in_bin, i].mean()) if in_bin.any() else np.nan,
+                })
+
+    scores = pd.DataFrame(scores)
+    daily.to_csv(os.path.join(outdir, 'walk_forward_daily.csv'), index=False)
+    scores.to_csv(os.path.join(outdir, 'walk_forward_scores.csv'), index=False)
+    pd.DataFrame(calibration).to_csv(os.path.join(outdir, 'walk_forward_calibration.csv'), index=False)
+    return scores
+
+
+CHECKPOINT_FILE = 'backtest_checkpoint.json'
+OPEN_BREAK_COLUMNS = ('pdh_break_success', 'pdl_break_success', 'false_pdh_break', 'false_pdl_break')
+# levels that only depend on the previous bar, so they can be computed from the checkpoint
+INCREMENTAL_LEVELS = ('PDH', 'PDL', 'TC', 'BC', 'PP', 'R1', 'S1', 'R2', 'S2')
+_PENDING_FIELDS = ('Open', 'High', 'Low', 'Close', 'PDH', 'PDL', 'prev_range', 'body_pct_prev',
+                   'candle_state', 'open_context')
+
+
+def _group_counters(df, keys, sum_cols, mean_col):
+    # Additive per-group state: row count, sums of the flag columns and the
+    # sum / non-null count of `mean_col`, so means can be updated without the rows.
+    g = df.groupby(keys, observed=True)
+    counters = g[list(sum_cols)].sum().astype(float)
+    counters.insert(0, 'count', g.size().astype(float))
+    counters[mean_col + '_sum'] = g[mean_col].sum()
+    counters[mean_col + '_n'] = g[mean_col].count().astype(float)
+    return counters
+
+
+def _add_counters(a, b):
+    return a.add(b, fill_value=0)
+
+
+def _stats_from_counters(counters, key, prob_cols, mean_col, avg_name):
+    stats = pd.DataFrame(index=counters.index)
+    stats['total_count'] = counters['count'].astype(int)
+    for col, name in prob_cols:
+        stats[name] = counters[col] / counters['count']
+    stats[avg_name] = counters[mean_col + '_sum'] / counters[mean_col + '_n']
+    stats = stats.sort_index().reset_index()
+    stats.columns = list(key) + list(stats.columns[len(key):])
+    return stats
+
+
+def _counters_to_json(counters):
+    rows = {}
+    for key, values in counters.iterrows():
+        name = '|'.join(key) if isinstance(key, tuple) else key
+        rows[name] = [None if pd.isna(v) else float(v) for v in values]
+    return {'columns': list(counters.columns), 'rows': rows}
+
+
+def _counters_from_json(data, names=None):
+    counters = pd.DataFrame.from_dict(data['rows'], orient='index', columns=data['columns'], dtype=float)
+    if names:
+        counters.index = pd.MultiIndex.from_tuples([tuple(k.split('|')) for k in counters.index], names=names)
+    return counters
+
+
+# index names of the checkpoint counters keyed by more than one column
+_COUNTER_INDEX_NAMES = {'gap_counters': ['gap_direction', 'gap_bucket'], 'scenario_counters': ['scenario', 'outcome']}
+_CHECKPOINT_COUNTERS = ('candle_counters', 'open_counters', 'gap_counters', 'scenario_counters')
+
+
+def build_checkpoint(df, levels=LEVEL_GAME_LEVELS, fill_fractions=GAP_FILL_FRACTIONS, level_daily=None):
+    """
+    Capture the state needed to append new bars without re-reading history.
 
+    The last bar stays "pending": its next-day outcome is unknown, so it is
+    kept out of the candle/open counters until the following bar arrives.
+    `level_daily` is df's level_game_daily() table for `levels` when the caller has it.
+    """
+    finalized = df.iloc[:-1]
+    last = df.iloc[-1]
+    fill_cols = [gap_fill_column(f) for f in fill_fractions]
+    body = df['body_pct_prev'].to_numpy(dtype=float)
+    return {
+        'version': 1,
+        'levels': list(levels),
+        'fill_fractions': list(fill_fractions),
+        'last_date': pd.Timestamp(last['Date']).isoformat(),
+        'last_bar': {k: (None if pd.isna(last[k]) else (last[k] if isinstance(last[k], str) else float(last[k])))
+                     for k in _PENDING_FIELDS},
+        'body_pct_window': [None if np.isnan(v) else float(v) for v in body[-BODY_PCT_WINDOW:]],
+        'body_pct_sorted': np.sort(body[~np.isnan(body)]),
+        'candle_counters': _group_counters(finalized, 'candle_state', OUTCOME_CLASS_COLUMNS, 'next_range_pct'),
+        'open_counters': _group_counters(finalized, 'open_context', OUTCOME_CLASS_COLUMNS + OPEN_BREAK_COLUMNS,
+                                         'next_range_pct'),
+        'gap_counters': _group_counters(gap_frame(df, fill_fractions), ['gap_direction', 'gap_bucket'],
+                                        fill_cols, 'gap_size_pct'),
+        'scenario_counters': level_scenario_counts(scenario_level_daily(df, levels, level_daily)),
+    }
+
+
+def save_checkpoint(checkpoint, path):
+    data = dict(checkpoint)
+    data['body_pct_sorted'] = np.asarray(checkpoint['body_pct_sorted']).tolist()
+    for name in _CHECKPOINT_COUNTERS:
+        data[name] = _counters_to_json(checkpoint[name])
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def load_checkpoint(path):
+    with open(path) as f:
+        data = json.load(f)
+    data['body_pct_sorted'] = np.asarray(data['body_pct_sorted'], dtype=float)
+    if 'scenario_counters' not in data:
+        # checkpoints from before level_scenario_stats.csv: count the days already written,
+        # which only works when they were written for the scenarios' levels
+        if tuple(data['levels']) != LEVEL_GAME_LEVELS:
+            raise ValueError('Checkpoint predates level_scenario_stats.csv and was built with --levels '
+                             f"{','.join(data['levels'])}; rerun without --incremental.")
+        daily = pd.read_csv(os.path.join(os.path.dirname(path), 'level_game_daily.csv'))
+        data['scenario_counters'] = _counters_to_json(level_scenario_counts(daily))
+    for name in _CHECKPOINT_COUNTERS:
+        data[name] = _counters_from_json(data[name], _COUNTER_INDEX_NAMES.get(name))
+    return data
+
+
+def write_checkpoint_stats(checkpoint, outdir):
+    """Write candle/open/gap stats and thresholds from the checkpoint's counters."""
+    pending = checkpoint['last_bar']
+    prob_trend = [(col, 'prob_' + col) for col in OUTCOME_CLASS_COLUMNS]
+
+    # the pending bar counts towards total_count with no outcome, as in a full run
+    candle = checkpoint['candle_counters'].copy()
+    candle.loc[pending['candle_state']] = candle.reindex([pending['candle_state']]).fillna(0).iloc[0]
+    candle.loc[pending['candle_state'], 'count'] += 1
+    candle_stats = _stats_from_counters(candle, ['candle_state'], prob_trend,
+                                        'next_range_pct', 'avg_next_day_range_pct')
+    candle_stats.to_csv(os.path.join(outdir, 'candle_state_stats.csv'), index=False)
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--input', '-i', default='/workspaces/Trading-Dashboard/Nifty Data.xlsx', help='Input Excel/CSV file')
-    parser.add_argument('--output', '-o', default='data', help='Output directory for CSVs')
-    parser.add_argument('--header-row', type=int, default=3, help='1-based row number that contains column headers (default: 3)')
-    args = parser.parse_args()
+    open_ = checkpoint['open_counters'].copy()
+    open_.loc[pending['open_context']] = open_.reindex([pending['open_context']]).fillna(0).iloc[0]
+    open_.loc[pending['open_context'], 'count'] += 1
+    open_stats = _stats_from_counters(open_, ['open_context'],
+                                      prob_trend + [(col, 'prob_' + col) for col in OPEN_BREAK_COLUMNS],
+                                      'next_range_pct', 'avg_next_day_range_pct')
+    open_stats.to_csv(os.path.join(outdir, 'open_context_stats.csv'), index=False)
 
-    try:
-        header_idx = max(0, args.header_row - 1)
-        df = load_data(args.input, header_idx=header_idx)
-    except Exception as e:
-        print('Failed to read input file:', e)
-        sys.exit(1)
+    # every observed direction gets a row per bucket, like groupby(observed=False)
+    gap = checkpoint['gap_counters']
+    full_index = pd.MultiIndex.from_product(
+        [sorted(gap.index.get_level_values(0).unique()), list(GAP_BUCKET_LABELS)],
+        names=['gap_direction', 'gap_bucket'])
+    gap = gap.reindex(full_index, fill_value=0)
+    fill_cols = [gap_fill_column(f) for f in checkpoint['fill_fractions']]
+    gap_stats = _stats_from_counters(gap, ['gap_direction', 'gap_bucket'],
+                                     [(col, 'prob_' + col) for col in fill_cols],
+                                     'gap_size_pct', 'avg_gap_size_pct')
+    # sort_index ordered buckets as strings; restore the bucket order
+    gap_stats['gap_bucket'] = pd.Categorical(gap_stats['gap_bucket'], categories=GAP_BUCKET_LABELS)
+    gap_stats = gap_stats.sort_values(['gap_direction', 'gap_bucket']).reset_index(drop=True)
+    gap_stats.to_csv(os.path.join(outdir, 'gap_stats.csv'), index=False)
+
+    write_thresholds(checkpoint['body_pct_sorted'], outdir)
+    level_scenario_stats(checkpoint['scenario_counters']).to_csv(
+        os.path.join(outdir, 'level_scenario_stats.csv'), index=False)
+
+
+def update_incremental(new_bars, checkpoint, outdir, write_stats=True):
+    """
+    Append `new_bars` (normalized OHLC rows after the checkpoint's last bar) to
+    the outputs in `outdir` and return the updated checkpoint.
+
+    Work is proportional to len(new_bars): the previous bar and the rolling
+    body_pct window come from the checkpoint, and the stats tables are
+    rewritten from the running counters (skipped when `write_stats` is False).
+    """
+    last = checkpoint['last_bar']
+    fractions = tuple(checkpoint['fill_fractions'])
+    levels = tuple(checkpoint['levels'])
+
+    # explicit float64 OHLC: a pending bar with missing prices would otherwise be an all-NA
+    # object row, whose dtype pandas is deprecating ignoring in concat
+    ohlc = ['Open', 'High', 'Low', 'Close']
+    prev_bar = pd.DataFrame({'Date': [pd.Timestamp(checkpoint['last_date'])],
+                             **{k: np.array([np.nan if last[k] is None else last[k]], dtype=float) for k in ohlc}})
+    ctx = pd.concat([prev_bar, new_bars[['Date'] + ohlc].astype(dict.fromkeys(ohlc, float))], ignore_index=True)
+    add_prev_day_features(ctx)
+    # row 0 is the pending bar: restore the features it had when it was classified
+    for col in ('PDH', 'PDL', 'prev_range', 'body_pct_prev'):
+        ctx.loc[0, col] = np.nan if last[col] is None else last[col]
+
+    window = [np.nan if v is None else v for v in checkpoint['body_pct_window']]
+    classify_previous_candle(ctx, body_pct_history=window[:-1])
+    classify_open_context(ctx)
+    ctx.loc[0, 'candle_state'] = last['candle_state']
+    ctx.loc[0, 'open_context'] = last['open_context']
+    add_next_day_columns(ctx)
+    label_next_day_outcomes(ctx, composite=False)
+    gap_analysis(ctx, fill_fractions=fractions)
+
+    # the old pending bar and every new bar but the last now have a next day
+    finalized = ctx.iloc[:-1]
+    new_rows = ctx.iloc[1:]
+    fill_cols = [gap_fill_column(f) for f in fractions]
+    checkpoint = dict(checkpoint)
+    checkpoint['candle_counters'] = _add_counters(
+        checkpoint['candle_counters'],
+        _group_counters(finalized, 'candle_state', OUTCOME_CLASS_COLUMNS, 'next_range_pct'))
+    checkpoint['open_counters'] = _add_counters(
+        checkpoint['open_counters'],
+        _group_counters(finalized, 'open_context', OUTCOME_CLASS_COLUMNS + OPEN_BREAK_COLUMNS, 'next_range_pct'))
+    new_gaps = gap_frame(new_rows, fractions)
+    new_gaps['gap_bucket'] = new_gaps['gap_bucket'].astype(str)
+    checkpoint['gap_counters'] = _add_counters(
+        checkpoint['gap_counters'],
+        _group_counters(new_gaps, ['gap_direction', 'gap_bucket'], fill_cols, 'gap_size_pct'))
+
+    body = new_rows['body_pct_prev'].to_numpy(dtype=float)
+    new_body = np.sort(body[~np.isnan(body)])
+    sorted_body = checkpoint['body_pct_sorted']
+    checkpoint['body_pct_sorted'] = np.insert(sorted_body, np.searchsorted(sorted_body, new_body), new_body)
+    checkpoint['body_pct_window'] = (checkpoint['body_pct_window']
+                                     + [None if np.isnan(v) else float(v) for v in body])[-BODY_PCT_WINDOW:]
+
+    tail = ctx.iloc[-1]
+    checkpoint['last_date'] = pd.Timestamp(tail['Date']).isoformat()
+    checkpoint['last_bar'] = {k: (None if pd.isna(tail[k]) else (tail[k] if isinstance(tail[k], str) else float(tail[k])))
+                              for k in _PENDING_FIELDS}
+
+    new_rows = new_rows.reset_index(drop=True)
+    level_rows = level_game_daily(new_rows, levels)
+    level_rows.to_csv(os.path.join(outdir, 'level_game_daily.csv'), mode='a', header=False, index=False)
+    checkpoint['scenario_counters'] = _add_counters(
+        checkpoint['scenario_counters'], level_scenario_counts(scenario_level_daily(new_rows, levels, level_rows)))
+    if write_stats:
+        write_checkpoint_stats(checkpoint, outdir)
+    return checkpoint
+
+
+def stream_backtest(chunks, outdir, levels=LEVEL_GAME_LEVELS, fill_fractions=GAP_FILL_FRACTIONS, checkpoint=None):
+    """
+    Run the backtest over an iterable of raw OHLC chunks in date order.
+
+    Only one chunk is in memory at a time: the bar before each chunk, the
+    20-bar body_pct window and the group aggregates travel in the checkpoint,
+    so shift(1)/shift(-1) and the rolling thresholds see across chunk edges.
+    Starting from an existing `checkpoint` only appends bars after it.
+    Returns (checkpoint, number of bars processed).
+    """
+    os.makedirs(outdir, exist_ok=True)
+    processed = 0
+    for chunk in chunks:
+        chunk = normalize_ohlc(chunk)
+        if not pd.api.types.is_datetime64_any_dtype(chunk['Date']):
+            raise ValueError('Incremental and chunked runs need a parseable Date column')
+        chunk = chunk[chunk['Date'].notna()]
+        chunk[['Open', 'High', 'Low', 'Close']] = chunk[['Open', 'High', 'Low', 'Close']].astype(float)
+        if checkpoint is not None:
+            after = chunk['Date'] > pd.Timestamp(checkpoint['last_date'])
+            if processed and not after.all():
+                raise ValueError('Chunked input must be sorted by Date')
+            chunk = chunk[after]
+        if chunk.empty:
+            continue
+        chunk = chunk.reset_index(drop=True)
+        if checkpoint is None:
+            add_prev_day_features(chunk)
+            classify_previous_candle(chunk)
+            classify_open_context(chunk)
+            add_next_day_columns(chunk)
+            label_next_day_outcomes(chunk, composite=False)
+            gap_analysis(chunk, fill_fractions=fill_fractions)
+            level_daily = compute_level_game_stats(chunk, outdir, levels=levels)
+            checkpoint = build_checkpoint(chunk, levels, fill_fractions, level_daily)
+        else:
+            checkpoint = update_incremental(chunk, checkpoint, outdir, write_stats=False)
+        processed += len(chunk)
+    if processed:
+        write_checkpoint_stats(checkpoint, outdir)
+    return checkpoint, processed
 
+
+def check_parity(df, stage, columns):
+    """Re-run `stage` with the reference engine on a copy of `df` and compare `columns`.
+
+    Returns a list of (column, mismatch_count) for every column that differs.
+    """
+    ref = df.copy()
+    stage(ref, engine='reference')
+    mismatches = []
+    for col in columns:
+        a = pd.Series(df[col], dtype=object)
+        b = pd.Series(ref[col], dtype=object)
+        same = (a == b) | (a.isna() & b.isna())
+        if not same.all():
+            mismatches.append((col, int((~same).sum())))
+    return mismatches
+
+
+def normalize_ohlc(df):
+    """Rename the OHLC columns to Open/High/Low/Close, parse Date and sort by it."""
     # try to find OHLC columns
     ocol, hcol, lcol, ccol = find_ohlc_cols(df.columns)
     if not all([ocol, hcol, lcol, ccol]):
-        print('Could not find Open/High/Low/Close columns automatically. Columns found:', list(df.columns))
-        sys.exit(1)
+        raise ValueError(f'Could not find Open/High/Low/Close columns automatically. Columns found: {list(df.columns)}')
 
     # normalize column names
     df = df.rename(columns={ocol: 'Open', hcol: 'High', lcol: 'Low', ccol: 'Close'})
@@ -481,62 +1624,1035 @@ def main():
         df = df.sort_values('Date').reset_index(drop=True)
     else:
         df = df.reset_index().rename(columns={'index': 'Date'})
+    return df
 
-    # previous day metrics
-    df['PDH'] = df['High'].shift(1)
-    df['PDL'] = df['Low'].shift(1)
-    df['PDC'] = df['Close'].shift(1)
-    df['PDO'] = df['Open'].shift(1)
-    df['prev_close'] = df['PDC']
-    df['prev_range'] = df['PDH'] - df['PDL']
 
-    # CPR
-    df['PP'] = (df['PDH'] + df['PDL'] + df['PDC']) / 3.0
-    df['BC'] = (df['PDH'] + df['PDL']) / 2.0
-    df['TC'] = (df['PP'] - df['BC']) + df['PP']
-    # Swap if TC < BC to ensure TC is max and BC is min
-    swap_mask = df['TC'] < df['BC']
-    df.loc[swap_mask, ['TC', 'BC']] = df.loc[swap_mask, ['BC', 'TC']].values
-    df['CPR_width'] = df['TC'] - df['BC']
+def excel_cache_path(path: str, header: int = 2) -> str:
+    """Location of the columnar cache for workbook `path`: a hidden .npz next to it."""
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f'.{name}.h{header}.cache.npz')
 
-    # candle structure metrics for previous day
-    df['range_prev'] = df['prev_range']
-    df['body_prev'] = (df['PDC'] - df['PDO']).abs()
-    df['upper_wick_prev'] = df['PDH'] - df[['PDO', 'PDC']].max(axis=1)
-    df['lower_wick_prev'] = df[['PDO', 'PDC']].min(axis=1) - df['PDL']
 
-    df['body_pct_prev'] = safe_div(df['body_prev'], df['range_prev'])
-    df['upper_wick_pct_prev'] = safe_div(df['upper_wick_prev'], df['range_prev'])
-    df['lower_wick_pct_prev'] = safe_div(df['lower_wick_prev'], df['range_prev'])
-    df['wick_imbalance_prev'] = safe_div(df['upper_wick_prev'] - df['lower_wick_prev'], df['range_prev'])
-    df['top_rejection_prev'] = safe_div(df['PDH'] - df['PDC'], df['range_prev'])
-    df['bottom_rejection_prev'] = safe_div(df['PDC'] - df['PDL'], df['range_prev'])
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _frame_to_arrays(df):
+    # One typed array per column; object columns must be all strings (plus nulls)
+    # so the cache loads without pickle. Returns None for frames it can't store.
+    if not all(isinstance(c, str) for c in df.columns):
+        return None
+    arrays = {'columns': np.array(df.columns, dtype=str)}
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        if values.dtype == object:
+            null = values.isna().to_numpy()
+            if not values[~null].map(type).eq(str).all():
+                return None
+            arrays[f'col{i}'] = values.where(~null, '').to_numpy(dtype=str)
+            arrays[f'null{i}'] = null
+        elif values.dtype.kind in 'biufM':
+            arrays[f'col{i}'] = values.to_numpy()
+        else:
+            return None
+    return arrays
+
+
+def _frame_from_arrays(arrays):
+    data = {}
+    for i, col in enumerate(arrays['columns']):
+        values = arrays[f'col{i}']
+        if f'null{i}' in arrays:
+            values = values.astype(object)
+            values[arrays[f'null{i}']] = np.nan
+        data[str(col)] = values
+    return pd.DataFrame(data)
+
+
+def read_excel_cached(path: str, header: int = 2) -> pd.DataFrame:
+    """
+    `pd.read_excel(path, header=header)`, served from a columnar .npz cache
+    next to the workbook when the workbook is unchanged.
+
+    The cache is keyed by the workbook's size, mtime and SHA-256: a matching
+    size and mtime is trusted as is, otherwise the hash decides. A missing,
+    stale or unreadable cache is rebuilt from openpyxl on this call.
+    """
+    stat = os.stat(path)
+    cache = excel_cache_path(path, header)
+    sha256 = None
+    if os.path.exists(cache):
+        try:
+            with np.load(cache, allow_pickle=False) as z:
+                if int(z['size']) == stat.st_size:
+                    fresh = int(z['mtime_ns']) == stat.st_mtime_ns
+                    if not fresh:
+                        sha256 = _file_sha256(path)
+                        fresh = str(z['sha256']) == sha256
+                    if fresh:
+                        return _frame_from_arrays(z)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    df = pd.read_excel(path, header=header)
+    arrays = _frame_to_arrays(df)
+    if arrays is not None:
+        arrays.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=sha256 or _file_sha256(path))
+        # per process and thread: the backtest and the app's background reads may rebuild it at once
+        tmp = f'{cache}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, cache)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+    return df
+
+
+# Explicit formats tried (in order, day-first before month-first) when
+# inferring the schema of a text Date column.
+DATE_FORMATS = ('%d-%m-%Y', '%d/%m/%Y', '%d-%m-%Y %H:%M', '%d/%m/%Y %H:%M', '%d-%m-%Y %H:%M:%S',
+                '%d/%m/%Y %H:%M:%S', '%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%d-%b-%Y',
+                '%d %b %Y', '%d-%b-%y', '%m/%d/%Y')
+SCHEMA_SAMPLE_ROWS = 1000
+
+
+def schema_path(path: str, header: int = 2) -> str:
+    """Location of the inferred read schema for `path`: a hidden .json next to it."""
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f'.{name}.h{header}.schema.json')
+
+
+def _is_excel(path):
+    return path.lower().endswith('.xlsx') or path.lower().endswith('.xls')
+
+
+def infer_date_format(values):
+    """First DATE_FORMATS entry that parses every non-null sample value, else None."""
+    values = pd.Series(values).dropna().astype(str).str.strip()
+    if values.empty:
+        return None
+    for fmt in DATE_FORMATS:
+        if pd.to_datetime(values, format=fmt, errors='coerce').notna().all():
+            return fmt
+    return None
+
+
+def infer_schema(sample: pd.DataFrame) -> dict:
+    """
+    Read schema for a raw input sample: which columns the backtest uses (Date
+    and the OHLC columns picked by find_ohlc_cols), their dtypes, and the
+    explicit format of a text Date column (None when it is already datetime
+    or no format fits, in which case parsing falls back to day-first).
+    """
+    raw = [str(c) for c in sample.columns]
+    stripped = [c.strip() for c in raw]
+    ohlc = find_ohlc_cols(pd.Index(stripped))
+    if not all(ohlc):
+        raise ValueError(f'Could not find Open/High/Low/Close columns automatically. Columns found: {stripped}')
+    date_col = 'Date' if 'Date' in stripped else None
+    usecols = ([date_col] if date_col else []) + list(ohlc)
+    date_format = None
+    if date_col and not pd.api.types.is_datetime64_any_dtype(sample[raw[stripped.index(date_col)]]):
+        date_format = infer_date_format(sample[raw[stripped.index(date_col)]])
+    return {
+        'version': 1,
+        'columns': stripped,
+        'usecols': [raw[stripped.index(c)] for c in usecols],
+        'date_column': date_col,
+        'date_format': date_format,
+        'dtypes': {raw[stripped.index(c)]: 'float64' for c in ohlc},
+    }
+
+
+_DATE_DIRECTIVE_WIDTHS = {'%Y': 4, '%m': 2, '%d': 2, '%H': 2, '%M': 2, '%S': 2}
+
+
+def _fixed_width_layout(fmt):
+    # ({directive: byte offset}, total width, [(offset, literal byte)]) for
+    # formats made only of zero-padded numeric directives and literal ASCII
+    # characters; None otherwise
+    offsets, literals, pos, i = {}, [], 0, 0
+    while i < len(fmt):
+        if fmt[i] == '%':
+            directive = fmt[i:i + 2]
+            if directive not in _DATE_DIRECTIVE_WIDTHS or directive in offsets:
+                return None
+            offsets[directive] = pos
+            pos += _DATE_DIRECTIVE_WIDTHS[directive]
+            i += 2
+        else:
+            if not fmt[i].isascii():
+                return None
+            literals.append((pos, ord(fmt[i])))
+            pos += 1
+            i += 1
+    if not {'%Y', '%m', '%d'} <= set(offsets) or ('%S' in offsets and '%M' not in offsets) \
+            or ('%M' in offsets) != ('%H' in offsets):
+        return None
+    return offsets, pos, literals
+
+
+def _years_in_ns_range(chars, offsets):
+    # datetime64[ns] holds 1677-09-21 .. 2262-04-11; numpy wraps dates outside it
+    # instead of failing, so the edge years and beyond are left to pandas
+    if '%Y' not in offsets:
+        return True
+    start = offsets['%Y']
+    year = sum((chars[:, start + k].astype(np.int32) - 48) * 10 ** (3 - k) for k in range(4))
+    return bool(((year > 1677) & (year < 2262)).all())
+
+
+def parse_dates(values, fmt):
+    """
+    `pd.to_datetime(values, format=fmt, errors='coerce')` on stripped values,
+    with a fast path for fixed-width numeric formats such as '%d-%m-%Y %H:%M':
+    when every value has digits and separators exactly where the format puts
+    them, the bytes are rearranged into ISO order and parsed by numpy.
+    Anything irregular (other widths, nulls, bad values, years outside the
+    datetime64[ns] range) goes through pandas.
+    """
+    values = pd.Series(values)
+    layout = _fixed_width_layout(fmt)
+    # astype('S<width>') truncates longer strings, so the width is checked first
+    if layout is not None and values.dtype == object and len(values) and \
+            (values.str.len() == layout[1]).all():
+        offsets, width, literals = layout
+        try:
+            raw = values.to_numpy().astype(f'S{width}')
+        except (TypeError, UnicodeError):
+            raw = None
+        if raw is not None:
+            chars = raw.view(np.uint8).reshape(len(raw), width)
+            literal_pos = [p for p, _ in literals]
+            digit_pos = sorted(set(range(width)) - set(literal_pos))
+            if ((chars[:, digit_pos] - 48) <= 9).all() and \
+                    (chars[:, literal_pos] == np.array([c for _, c in literals], dtype=np.uint8)).all() and \
+                    _years_in_ns_range(chars, offsets):
+                columns = []
+                for directive, sep in (('%Y', b''), ('%m', b'-'), ('%d', b'-'), ('%H', b'T'), ('%M', b':'),
+                                       ('%S', b':')):
+                    if directive in offsets:
+                        columns += [np.full(len(raw), c, dtype=np.uint8) for c in sep]
+                        start = offsets[directive]
+                        columns += [chars[:, start + k] for k in range(_DATE_DIRECTIVE_WIDTHS[directive])]
+                iso = np.ascontiguousarray(np.column_stack(columns)).view(f'S{len(columns)}').ravel()
+                unit = 's' if '%S' in offsets else 'm' if '%M' in offsets else 'D'
+                try:
+                    parsed = iso.astype(f'datetime64[{unit}]').astype('datetime64[ns]')
+                    return pd.Series(parsed, index=values.index)
+                except ValueError:
+                    pass  # e.g. 31-02-2020: let pandas coerce just the bad values
+    if values.dtype == object:
+        values = values.str.strip()
+    return pd.to_datetime(values, format=fmt, errors='coerce')
+
+
+def apply_schema(df: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    """Keep the schema's columns, coerce them to their dtypes and parse Date with the inferred format."""
+    df = df[[c for c in schema['usecols'] if c in df.columns]]
+    for col, dtype in schema['dtypes'].items():
+        if df[col].dtype != dtype:
+            # stray text in a numeric column becomes NaN instead of an object column
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype(dtype)
+    df.columns = df.columns.astype(str).str.strip()
+    date_col = schema['date_column']
+    if date_col and schema['date_format'] and not pd.api.types.is_datetime64_any_dtype(df[date_col]):
+        df[date_col] = parse_dates(df[date_col], schema['date_format'])
+    return df
+
+
+def load_schema(input_path: str, header_idx: int = 2, sample: Optional[pd.DataFrame] = None) -> dict:
+    """
+    The persisted schema for `input_path`, re-inferred (and re-saved) when it
+    is missing or the file's header no longer matches it. The schema file is
+    plain JSON and may be edited, e.g. to pick different OHLC columns.
+    """
+    path = schema_path(input_path, header_idx)
+    if sample is None:
+        sample = pd.read_csv(input_path, header=header_idx, nrows=SCHEMA_SAMPLE_ROWS)
+    columns = [str(c).strip() for c in sample.columns]
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                schema = json.load(f)
+            if schema.get('version') == 1 and schema.get('columns') == columns:
+                return schema
+        except (OSError, ValueError):
+            pass
+    schema = infer_schema(sample.head(SCHEMA_SAMPLE_ROWS))
+    try:
+        with open(path, 'w') as f:
+            json.dump(schema, f, indent=2)
+    except OSError:
+        pass
+    return schema
+
+
+def _read_csv_typed(input_path, header_idx, schema):
+    kwargs = dict(header=header_idx, usecols=schema['usecols'])
+    try:
+        return pd.read_csv(input_path, dtype=schema['dtypes'], **kwargs)
+    except ValueError:
+        # stray text in a numeric column; apply_schema coerces it to NaN
+        return pd.read_csv(input_path, **kwargs)
+
+
+def load_data(input_path: str, header_idx: int = 2) -> pd.DataFrame:
+    """Load Excel/CSV using header at zero-based `header_idx`.
+
+    By default `header_idx=2` (i.e. header on Excel row 3, data from row 4).
+    Only Date and the OHLC columns are kept, typed per the file's schema
+    (see `load_schema`).
+    """
+    if _is_excel(input_path):
+        df = read_excel_cached(input_path, header=header_idx)
+        schema = load_schema(input_path, header_idx, sample=df)
+    else:
+        schema = load_schema(input_path, header_idx)
+        df = _read_csv_typed(input_path, header_idx, schema)
+    return apply_schema(df, schema)
+
+
+def iter_data_chunks(input_path: str, header_idx: int = 2, chunksize: int = 100_000):
+    """Yield the input as frames of at most `chunksize` rows, with the same header handling as `load_data`."""
+    if _is_excel(input_path):
+        from openpyxl import load_workbook
+        wb = load_workbook(input_path, read_only=True, data_only=True)
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        for _ in range(header_idx):
+            next(rows, None)
+        header = [f'Unnamed: {i}' if c is None else str(c).strip() for i, c in enumerate(next(rows))]
+        schema = None
+        batch = []
+        for row in rows:
+            batch.append(row[:len(header)])
+            if len(batch) == chunksize:
+                chunk = pd.DataFrame(batch, columns=header)
+                schema = schema or load_schema(input_path, header_idx, sample=chunk)
+                yield apply_schema(chunk, schema)
+                batch = []
+        if batch:
+            chunk = pd.DataFrame(batch, columns=header)
+            yield apply_schema(chunk, schema or load_schema(input_path, header_idx, sample=chunk))
+        wb.close()
+    else:
+        schema = load_schema(input_path, header_idx)
+        # untyped: a bad value deep in the file must not abort the stream midway
+        for chunk in pd.read_csv(input_path, header=header_idx, usecols=schema['usecols'], chunksize=chunksize):
+            yield apply_schema(chunk, schema)
+
+
+PROFILE_REPORT_FILE = 'profile_report.json'
+
+
+def _rss_mb():
+    # current resident set size (Linux /proc); None where unavailable
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+class StageProfiler:
+    """
+    Opt-in per-stage instrumentation for --profile.
+
+    `stage(name, df)` wraps one stage and records elapsed seconds, rows in
+    and out, the change in resident memory and the peak RSS so far. With a
+    `dump_dir` each stage is also run under cProfile and dumped to
+    `<dump_dir>/<name>.prof`. A disabled profiler is a no-op.
+    """
+
+    def __init__(self, enabled=False, dump_dir=None):
+        self.enabled = enabled or dump_dir is not None
+        self.dump_dir = dump_dir
+        self.stages = []
+        self.frame_mb = None  # deep size of the enriched frame, set by run_pipeline
+
+    @contextlib.contextmanager
+    def stage(self, name, df=None):
+        record = {'stage': name, 'rows_in': None if df is None else len(df)}
+        if not self.enabled:
+            yield record
+            return
+        profile = cProfile.Profile() if self.dump_dir else None
+        rss_before = _rss_mb()
+        start = time.perf_counter()
+        if profile:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile:
+                profile.disable()
+            record['seconds'] = time.perf_counter() - start
+            # in-place stages keep the frame; others set rows_out on the record
+            record.setdefault('rows_out', None if df is None else len(df))
+            rss_after = _rss_mb()
+            record['rss_delta_mb'] = None if rss_before is None or rss_after is None else rss_after - rss_before
+            record['peak_rss_mb'] = _peak_rss_mb()
+            if profile:
+                os.makedirs(self.dump_dir, exist_ok=True)
+                profile.dump_stats(os.path.join(self.dump_dir, f'{name}.prof'))
+            self.stages.append(record)
+
+    def report(self, outdir):
+        """Print the summary table and write PROFILE_REPORT_FILE into `outdir`."""
+        if not self.enabled:
+            return
+        def cell(value, width, spec=''):
+            return f'{value:>{width}{spec}}' if value is not None else f"{'-':>{width}}"
+        print(f"{'stage':<28}{'seconds':>10}{'rows in':>12}{'rows out':>12}{'RSS delta MB':>14}{'peak RSS MB':>13}")
+        for r in self.stages:
+            print(f"{r['stage']:<28}{r['seconds']:>10.3f}{cell(r['rows_in'], 12)}{cell(r['rows_out'], 12)}"
+                  f"{cell(r['rss_delta_mb'], 14, '.1f')}{cell(r['peak_rss_mb'], 13, '.1f')}")
+        total = sum(r['seconds'] for r in self.stages)
+        print(f"{'total':<28}{total:>10.3f}")
+        if self.frame_mb is not None:
+            print(f'enriched frame: {self.frame_mb:.1f} MB, peak RSS: {cell(_peak_rss_mb(), 0, ".1f")} MB')
+        os.makedirs(outdir, exist_ok=True)
+        with open(os.path.join(outdir, PROFILE_REPORT_FILE), 'w') as f:
+            json.dump({'total_seconds': total, 'stages': self.stages, 'frame_mb': self.frame_mb,
+                       'peak_rss_mb': _peak_rss_mb(), 'cprofile_dir': self.dump_dir}, f, indent=2)
+
+
+# --lean, per stage: columns that no later stage compares against a cutoff or
+# writes out (held as float32 from then on) and intermediates that nothing
+# later reads, including the walk-forward and the checkpoint (dropped). Label
+# strings become categoricals.
+LEAN_FLOAT32_AFTER = {
+    'add_prev_day_features': ('CPR_width',),
+    'label_next_day_outcomes': ('next_range_pct',),
+    'gap_analysis': ('gap',),
+}
+LEAN_DROP_AFTER = {
+    'add_prev_day_features': ('PDC', 'PDO', 'range_prev', 'body_prev', 'upper_wick_prev', 'lower_wick_prev'),
+    'classify_previous_candle': ('upper_wick_pct_prev', 'lower_wick_pct_prev', 'wick_imbalance_prev',
+                                 'top_rejection_prev', 'bottom_rejection_prev'),
+    'label_next_day_outcomes': ('next_high', 'next_low', 'next_close', 'next_open'),
+    'gap_analysis': ('prev_close',),
+}
+LEAN_CATEGORY_COLUMNS = ('candle_state', 'open_context', 'next_day_outcome', 'expansion_flag', 'gap_direction')
+
+
+def shrink_frame(df, stage):
+    """Apply the --lean dtypes and drops for the columns `stage` has finished with."""
+    for col in LEAN_DROP_AFTER.get(stage, ()):
+        if col in df.columns:
+            del df[col]  # unlike drop(), only rewrites the block holding the column
+    for col in LEAN_FLOAT32_AFTER.get(stage, ()):
+        if col in df.columns:
+            df[col] = df[col].astype(np.float32)
+    for col in LEAN_CATEGORY_COLUMNS:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = df[col].astype('category')
+
+
+def frame_memory_mb(df):
+    """Deep in-memory size of `df` (object columns counted by their Python objects)."""
+    return df.memory_usage(deep=True).sum() / 2**20
+
+
+def run_pipeline(df, outdir, engine='vectorized', fill_fractions=GAP_FILL_FRACTIONS, levels=LEVEL_GAME_LEVELS,
+                 parity=False, profiler=None, lean=False):
+    """
+    Run every stage on a normalized OHLC frame and write the outputs to `outdir`.
+
+    Returns the (candle, open, gap, level scenario) stats tables and the parity mismatches
+    found when `parity` is set. Stages are timed through `profiler`
+    (a StageProfiler) when one is given. With `lean`, each stage's output is
+    passed through `shrink_frame` once its parity check (if any) has run.
+    """
+    profiler = profiler or StageProfiler()
+    parity_errors = []
+    shrink = shrink_frame if lean else (lambda df, stage: None)
+
+    with profiler.stage('add_prev_day_features', df):
+        add_prev_day_features(df)
+    shrink(df, 'add_prev_day_features')
 
     # classify previous candle
-    classify_previous_candle(df)
+    with profiler.stage('classify_previous_candle', df):
+        classify_previous_candle(df, engine=engine)
+    if parity:
+        parity_errors += check_parity(df, classify_previous_candle, ['candle_state'])
+    shrink(df, 'classify_previous_candle')
 
     # classify today's open context relative to previous day
-    classify_open_context(df)
+    with profiler.stage('classify_open_context', df):
+        classify_open_context(df, engine=engine)
+    if parity:
+        parity_errors += check_parity(df, classify_open_context, ['open_context'])
+    shrink(df, 'classify_open_context')
 
     # prepare next-day columns
-    df['next_high'] = df['High'].shift(-1)
-    df['next_low'] = df['Low'].shift(-1)
-    df['next_close'] = df['Close'].shift(-1)
-    df['next_open'] = df['Open'].shift(-1)
+    with profiler.stage('add_next_day_columns', df):
+        add_next_day_columns(df)
 
     # label next day outcomes
-    label_next_day_outcomes(df)
+    # the composite outcome string is only needed to compare against the reference engine
+    with profiler.stage('label_next_day_outcomes', df):
+        label_next_day_outcomes(df, engine=engine, composite=parity)
+    if parity:
+        parity_errors += check_parity(df, label_next_day_outcomes,
+                                      ['next_day_outcome', 'expansion_flag', 'next_range_pct'] + list(BREAK_FLAGS))
+    shrink(df, 'label_next_day_outcomes')
 
     # gap analysis (same-day fill probabilities)
-    gap_analysis(df)
+    with profiler.stage('gap_analysis', df):
+        gap_analysis(df, fill_fractions=fill_fractions, engine=engine)
+    if parity:
+        # the reference engine only knows the default fractions; compare the ones this run computed
+        parity_errors += check_parity(df, gap_analysis, [gap_fill_column(f) for f in GAP_FILL_FRACTIONS
+                                                         if f in fill_fractions])
+    shrink(df, 'gap_analysis')
 
     # aggregate and write outputs
-    aggregate_and_write(df, args.output)
+    with profiler.stage('aggregate_and_write', df) as record:
+        stats = aggregate_and_write(df, outdir, fill_fractions=fill_fractions, engine=engine)
+        record['rows_out'] = sum(len(table) for table in stats)
 
     # compute and write level game stats
-    compute_level_game_stats(df, args.output)
+    with profiler.stage('compute_level_game_stats', df) as record:
+        level_daily = compute_level_game_stats(df, outdir, engine=engine, levels=levels)
+        record['rows_out'] = len(level_daily)
+    if parity:
+        parity_errors += check_level_game_parity(df)
+
+    # aggregate the dashboard's Level Game scenarios from the per-day table
+    with profiler.stage('level_scenario_stats', level_daily) as record:
+        stats += (write_level_scenario_stats(scenario_level_daily(df, levels, level_daily), outdir),)
+        record['rows_out'] = len(stats[-1])
+
+    if profiler.enabled:
+        profiler.frame_mb = frame_memory_mb(df)
+    return stats, parity_errors
+
+
+BATCH_TABLES = ('candle_state_stats', 'open_context_stats', 'gap_stats', 'level_scenario_stats')
+
+
+def find_batch_inputs(source, header_idx=2):
+    """
+    Map symbol -> (path, header_idx) for a batch run.
+
+    `source` is either a directory, where every .xlsx/.xls/.csv file is one
+    symbol named after the file, or a JSON manifest mapping symbols to a path
+    or to {"path": ..., "header_row": ...}. Manifest paths are relative to it.
+    """
+    if os.path.isdir(source):
+        return {os.path.splitext(name)[0]: (os.path.join(source, name), header_idx)
+                for name in sorted(os.listdir(source))
+                if name.lower().endswith(('.xlsx', '.xls', '.csv')) and not name.startswith('.')}
+
+    with open(source) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(source))
+    inputs = {}
+    for symbol, entry in manifest.items():
+        if isinstance(entry, str):
+            entry = {'path': entry}
+        entry_header = max(0, entry['header_row'] - 1) if 'header_row' in entry else header_idx
+        inputs[symbol] = (os.path.join(base, entry['path']), entry_header)
+    return inputs
+
+
+def _run_symbol(job):
+    # process-pool worker: one symbol end to end; errors are returned, not raised,
+    # so one bad file doesn't stop the batch
+    symbol, path, header_idx, outdir, kwargs = job
+    start = time.perf_counter()
+    try:
+        df = normalize_ohlc(load_data(path, header_idx=header_idx))
+        stats, parity_errors = run_pipeline(df, outdir, **kwargs)
+    except Exception as e:
+        return {'symbol': symbol, 'rows': 0, 'seconds': time.perf_counter() - start, 'error': str(e)}
+    return {'symbol': symbol, 'rows': len(df), 'seconds': time.perf_counter() - start, 'error': None,
+            'stats': stats, 'parity_errors': parity_errors}
+
+
+def run_batch(inputs, outdir, workers=None, **kwargs):
+    """
+    Run the full pipeline for every symbol in `inputs` (see `find_batch_inputs`)
+    in a process pool, writing each to `outdir/<symbol>/` and the stats of all
+    symbols to `outdir/combined_<table>.csv` with a leading `symbol` column.
+
+    Returns the per-symbol results in input order.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    jobs = [(symbol, path, header_idx, os.path.join(outdir, symbol), kwargs)
+            for symbol, (path, header_idx) in inputs.items()]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        results = list(pool.map(_run_symbol, jobs))
+
+    done = [r for r in results if r['error'] is None]
+    for i, table in enumerate(BATCH_TABLES):
+        if done:
+            combined = pd.concat([r['stats'][i].assign(symbol=r['symbol']) for r in done], ignore_index=True)
+            combined = combined[['symbol'] + [c for c in combined.columns if c != 'symbol']]
+            combined.to_csv(os.path.join(outdir, f'combined_{table}.csv'), index=False)
+    return results
+
+
+def print_batch_report(results, elapsed):
+    print(f"{'symbol':<16}{'rows':>10}{'seconds':>10}{'rows/sec':>14}")
+    for r in results:
+        if r['error'] is not None:
+            print(f"{r['symbol']:<16}  failed: {r['error']}")
+            continue
+        rate = r['rows'] / r['seconds'] if r['seconds'] > 0 else float('inf')
+        print(f"{r['symbol']:<16}{r['rows']:>10}{r['seconds']:>10.3f}{rate:>14,.0f}")
+    total = sum(r['rows'] for r in results)
+    print(f'{len(results)} symbols, {total} rows in {elapsed:.3f}s ({total / elapsed:,.0f} rows/sec)')
+
+
+SWEEP_FEATURE_COLUMNS = ('body_pct_prev', 'upper_wick_pct_prev', 'lower_wick_pct_prev', 'wick_imbalance_prev',
+                         'top_rejection_prev', 'bottom_rejection_prev', 'next_high', 'next_low', 'next_close',
+                         'next_open', 'prev_range', 'PDH', 'PDL', 'open_context_mask', 'gap_direction', 'gap',
+                         'gap_size_pct')
+_SWEEP_FRAME = None
+# per-combination tables written by run_sweep, in evaluate_thresholds' order
+SWEEP_TABLES = ('candle_state_stats', 'open_context_stats', 'gap_stats')
+
+
+def sweep_features(df, fill_fractions=GAP_FILL_FRACTIONS):
+    """Enrich a normalized OHLC frame with every threshold-independent column the sweep needs."""
+    add_prev_day_features(df)
+    classify_open_context(df)
+    add_next_day_columns(df)
+    gap_analysis(df, fill_fractions=fill_fractions)
+    return df[list(SWEEP_FEATURE_COLUMNS) + [gap_fill_column(f) for f in fill_fractions]].copy()
+
+
+def sweep_grid(spec):
+    """Expand {threshold: [values, ...]} into one override dict per combination."""
+    unknown = set(spec) - set(CLASSIFIER_THRESHOLDS) - {'gap_edges'}
+    if unknown:
+        raise ValueError(f'Unknown sweep parameters: {sorted(unknown)}')
+    names = list(spec)
+    return [dict(zip(names, values)) for values in itertools.product(*(spec[name] for name in names))]
+
+
+def evaluate_thresholds(features, params, fill_fractions=GAP_FILL_FRACTIONS, min_count=30):
+    """
+    Classify `features` (from `sweep_features`) with one threshold combination.
+
+    Returns a summary dict and the (candle, open, gap) stats tables, as in
+    SWEEP_TABLES. `direction_edge` is the count-weighted spread of
+    prob_trend_up - prob_trend_down across candle states with at least
+    `min_count` days: how well the states separate next-day direction. It
+    depends on neither `gap_edges` nor `expansion_ratio`, whose effect shows
+    in `min_gap_bucket_count` / the gap table and in `expansion_rate`.
+    """
+    thresholds = dict(params)
+    edges = tuple(thresholds.pop('gap_edges', GAP_BUCKET_EDGES))
+    frame = features.copy(deep=False)  # new columns only; the shared frame is never written
+    classify_previous_candle(frame, thresholds=thresholds)
+    label_next_day_outcomes(frame, composite=False, thresholds=thresholds)
+    candle_stats, open_stats = candle_open_stats(frame)
+    df_gap = gap_frame(frame, fill_fractions, edges)
+    gap_counts = df_gap['gap_bucket'].value_counts()
+
+    has_next = frame['next_day_trend'].notna().to_numpy()
+    sampled = candle_stats[candle_stats['total_count'] >= min_count]
+    edge = np.nan
+    if len(sampled):
+        spread = sampled['prob_trend_up'] - sampled['prob_trend_down']
+        weights = sampled['total_count']
+        mean = np.average(spread, weights=weights)
+        edge = float(np.sqrt(np.average((spread - mean) ** 2, weights=weights)))
+    summary = {
+        **{name: (','.join(f'{e:g}' for e in value) if name == 'gap_edges' else value)
+           for name, value in params.items()},
+        'candle_states': len(candle_stats),
+        'states_with_min_count': len(sampled),
+        'min_state_count': int(candle_stats['total_count'].min()),
+        'trend_day_rate': float((frame['trend_up'] | frame['trend_down'])[has_next].mean()),
+        'expansion_rate': float((frame['expansion_flag'] == 'Expansion_Day')[has_next].mean()),
+        'min_gap_bucket_count': int(gap_counts.min()),
+        'direction_edge': edge,
+    }
+    return summary, (candle_stats, open_stats, gap_stats_table(df_gap, fill_fractions))
+
+
+def _init_sweep_worker(frame):
+    global _SWEEP_FRAME
+    if frame is not None:
+        _SWEEP_FRAME = frame
+
+
+def _evaluate_shared(job):
+    params, fill_fractions, min_count = job
+    return evaluate_thresholds(_SWEEP_FRAME, params, fill_fractions, min_count)
+
+
+def run_sweep(features, grid, outdir, workers=None, fill_fractions=GAP_FILL_FRACTIONS, min_count=30):
+    """
+    Evaluate every combination in `grid` (see `sweep_grid`) in a process pool
+    and write sweep_ranking.csv (one row per combination, best direction_edge
+    first) and sweep_<table>.csv for each of SWEEP_TABLES (that table for
+    every combination, with a leading `combo` column). Combinations differing
+    only in `gap_edges` or `expansion_ratio` tie on direction_edge and keep
+    their grid order.
+
+    `features` is built once; forked workers inherit it copy-on-write, other
+    start methods receive one pickled copy per worker rather than per task.
+    """
+    global _SWEEP_FRAME
+    _SWEEP_FRAME = features
+    shared = None if multiprocessing.get_start_method() == 'fork' else features
+    jobs = [(params, fill_fractions, min_count) for params in grid]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                             initializer=_init_sweep_worker, initargs=(shared,)) as pool:
+        results = list(pool.map(_evaluate_shared, jobs))
+
+    os.makedirs(outdir, exist_ok=True)
+    ranking = pd.DataFrame([summary for summary, _ in results])
+    ranking.insert(0, 'combo', range(len(ranking)))
+    ranking = ranking.sort_values('direction_edge', ascending=False, na_position='last', kind='stable')
+    ranking.insert(0, 'rank', range(1, len(ranking) + 1))
+    ranking.to_csv(os.path.join(outdir, 'sweep_ranking.csv'), index=False)
+
+    for t, table in enumerate(SWEEP_TABLES):
+        combined = pd.concat([tables[t].assign(combo=i) for i, (_, tables) in enumerate(results)], ignore_index=True)
+        combined = combined[['combo'] + [c for c in combined.columns if c != 'combo']]
+        combined.to_csv(os.path.join(outdir, f'sweep_{table}.csv'), index=False)
+    return ranking
+
+
+SNAPSHOT_DIR = 'snapshots'
+CURRENT_FILE = 'current.json'
+MANIFEST_FILE = 'manifest.json'
+SNAPSHOT_KEEP = 5
+
+
+def _write_json_atomic(path, data):
+    # write a sibling temp file, then rename over `path`: readers see the old or the new file, never half of one
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def current_snapshot(outdir):
+    """Manifest of the live snapshot in `outdir` (its current.json), or None if there is none."""
+    try:
+        with open(os.path.join(outdir, CURRENT_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def live_output_dir(outdir):
+    """Directory holding the current tables: the live snapshot when `outdir` has one, else `outdir` itself."""
+    manifest = current_snapshot(outdir)
+    return outdir if manifest is None else os.path.join(outdir, manifest['path'])
+
+
+def begin_snapshot(outdir, carry=()):
+    """
+    Create a staging directory for a new snapshot under `outdir/snapshots/`.
+
+    Files named in `carry` are copied in from the live output directory (when
+    present) so runs that extend the previous outputs, such as --incremental,
+    never modify a published snapshot.
+    """
+    version = time.strftime('%Y%m%dT%H%M%S') + f'_{time.time_ns() % 10**9:09d}'
+    staging = os.path.join(outdir, SNAPSHOT_DIR, f'.staging-{version}')
+    os.makedirs(staging)
+    live = live_output_dir(outdir)
+    for name in carry:
+        if os.path.exists(os.path.join(live, name)):
+            shutil.copy2(os.path.join(live, name), os.path.join(staging, name))
+    return staging
+
+
+def _manifest_entry(path):
+    # size, SHA-256 and (for CSVs) data rows, in one pass over the file
+    digest = hashlib.sha256()
+    newlines = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+            newlines += block.count(b'\n')
+    entry = {'bytes': os.path.getsize(path), 'sha256': digest.hexdigest()}
+    if path.endswith('.csv'):
+        entry['rows'] = max(newlines - 1, 0)
+    return entry
+
+
+def commit_snapshot(outdir, staging, params, keep=SNAPSHOT_KEEP, workers=None):
+    """
+    Publish a staging directory from `begin_snapshot` as the current snapshot.
+
+    Hashes every file (in a thread pool; hashlib releases the GIL), writes
+    manifest.json into the snapshot, renames it into place and then atomically
+    replaces `outdir/current.json` with the same manifest, so readers switch
+    from the old tables to the new ones all at once. Snapshots beyond the
+    `keep` newest are deleted. Returns the manifest.
+    """
+    files = sorted(os.path.relpath(os.path.join(root, name), staging).replace(os.sep, '/')
+                   for root, _, names in os.walk(staging) for name in names)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        entries = pool.map(_manifest_entry, [os.path.join(staging, name) for name in files])
+        manifest_files = dict(zip(files, entries))
+    version = os.path.basename(staging)[len('.staging-'):]
+    manifest = {
+        'version': version,
+        'path': f'{SNAPSHOT_DIR}/{version}',
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'params': params,
+        'files': manifest_files,
+    }
+    with open(os.path.join(staging, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(staging, os.path.join(outdir, SNAPSHOT_DIR, version))
+    _write_json_atomic(os.path.join(outdir, CURRENT_FILE), manifest)
+    prune_snapshots(outdir, keep)
+    return manifest
+
+
+def prune_snapshots(outdir, keep=SNAPSHOT_KEEP):
+    """Delete all but the `keep` newest snapshots (never the current one) and abandoned staging directories."""
+    root = os.path.join(outdir, SNAPSHOT_DIR)
+    current = (current_snapshot(outdir) or {}).get('version')
+    names = sorted(os.listdir(root))
+    staging = [n for n in names if n.startswith('.staging-')]
+    versions = [n for n in names if not n.startswith('.')]
+    # a staging directory younger than the current snapshot may belong to a run still in progress
+    stale = [n for n in staging if current and n[len('.staging-'):] < current]
+    for name in stale + [v for v in versions[:-keep or None] if v != current]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', '-i', default='/workspaces/Trading-Dashboard/Nifty Data.xlsx', help='Input Excel/CSV file')
+    parser.add_argument('--output', '-o', default='data', help='Output directory for CSVs')
+    parser.add_argument('--header-row', type=int, default=3, help='1-based row number that contains column headers (default: 3)')
+    parser.add_argument('--engine', choices=['vectorized', 'reference'], default='vectorized',
+                        help='Classification engine: array-based (default) or the original row loop')
+    parser.add_argument('--gap-fills', default='50,80,100',
+                        help='Comma-separated gap fill percentages to compute (default: 50,80,100)')
+    parser.add_argument('--levels', default=','.join(LEVEL_GAME_LEVELS),
+                        help='Comma-separated Level Game levels from LEVEL_DEFINITIONS '
+                             '(default: PDH,PDL,TC,BC; also PP,R1,R2,S1,S2,PWH,PWL,PMH,PML)')
+    parser.add_argument('--check-parity', action='store_true',
+                        help='Also run the reference engine and fail if any classification differs')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process bars newer than the checkpoint in the output directory '
+                             '(a full run creates the checkpoint)')
+    parser.add_argument('--chunksize', type=int, default=0,
+                        help='Stream the input in chunks of this many rows to bound memory (0 = load it whole)')
+    parser.add_argument('--batch',
+                        help='Directory of per-symbol input files, or a JSON manifest of symbol -> path; '
+                             'each symbol is written to <output>/<symbol>/')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Processes for --batch and --sweep (default: one per core)')
+    parser.add_argument('--sweep',
+                        help='JSON grid of classifier thresholds ({name: [values]}) to evaluate instead of a normal run')
+    parser.add_argument('--profile', action='store_true',
+                        help=f'Print per-stage time, rows and memory and write {PROFILE_REPORT_FILE} to the output directory')
+    parser.add_argument('--profile-dump', metavar='DIR',
+                        help='Also run each stage under cProfile and write <DIR>/<stage>.prof (implies --profile)')
+    parser.add_argument('--snapshot', action='store_true',
+                        help=f'Write the run into a new <output>/{SNAPSHOT_DIR}/<version>/ directory with a manifest, '
+                             f'then atomically point <output>/{CURRENT_FILE} at it')
+    parser.add_argument('--keep-snapshots', type=int, default=SNAPSHOT_KEEP,
+                        help=f'Snapshots to keep with --snapshot (default: {SNAPSHOT_KEEP})')
+    parser.add_argument('--lean', action='store_true',
+                        help='Hold labels as categoricals and finished features as float32, and drop '
+                             'intermediate columns once consumed, to cut memory')
+    parser.add_argument('--walk-forward', action='store_true',
+                        help='Also score out-of-sample (prior-data-only) probabilities and write walk_forward_*.csv')
+    parser.add_argument('--walk-forward-min-count', type=int, default=20,
+                        help='Minimum prior days in a group before its walk-forward probability is scored (default: 20)')
+    parser.add_argument('--sweep-min-count', type=int, default=30,
+                        help='Minimum days for a candle state to count towards the sweep ranking (default: 30)')
+    args = parser.parse_args()
+
+    if not args.snapshot:
+        summary = run_backtest(args, args.output)
+        if summary:
+            print(summary, 'CSVs written to', args.output)
+        return
+
+    os.makedirs(args.output, exist_ok=True)
+    carry = () if args.batch or args.sweep else (CHECKPOINT_FILE,)
+    if args.incremental:
+        carry += ('level_game_daily.csv',)
+    staging = begin_snapshot(args.output, carry)
+    try:
+        summary = run_backtest(args, staging)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    if not summary:
+        shutil.rmtree(staging, ignore_errors=True)
+        return
+    params = {k: v for k, v in vars(args).items() if k != 'output'}
+    manifest = commit_snapshot(args.output, staging, params, keep=args.keep_snapshots)
+    # the staging directory run_backtest wrote to has just been renamed
+    print(summary, 'CSVs written to', os.path.join(args.output, manifest['path']))
+    print(f"Snapshot {manifest['version']} is now current ({len(manifest['files'])} files, "
+          f"{os.path.join(args.output, CURRENT_FILE)})")
+
+
+def run_backtest(args, outdir):
+    """
+    Run the mode selected by the parsed CLI `args`, writing into `outdir`.
+
+    Returns a one-line summary for `main` to print with the directory the
+    outputs end up in, or None if nothing was written.
+    """
+    header_idx = max(0, args.header_row - 1)
+    profiler = StageProfiler(enabled=args.profile, dump_dir=args.profile_dump)
+    fill_fractions = tuple(float(p) / 100 for p in args.gap_fills.split(','))
+    if args.engine == 'reference' and fill_fractions != GAP_FILL_FRACTIONS:
+        print('The reference engine only supports the default --gap-fills (50,80,100).')
+        sys.exit(1)
+    levels = tuple(args.levels.split(','))
+    unknown = [name for name in levels if name not in LEVEL_DEFINITIONS]
+    if unknown:
+        print(f"Unknown --levels {','.join(unknown)}; registered levels: {','.join(LEVEL_DEFINITIONS)}")
+        sys.exit(1)
+    if args.engine == 'reference' and levels != LEVEL_GAME_LEVELS:
+        print(f"The reference engine only supports the default --levels ({','.join(LEVEL_GAME_LEVELS)}).")
+        sys.exit(1)
+    checkpoint_path = os.path.join(outdir, CHECKPOINT_FILE)
+
+    if args.incremental or args.chunksize:
+        if set(levels) - set(INCREMENTAL_LEVELS):
+            print('Incremental and chunked runs only support previous-day levels:', ','.join(INCREMENTAL_LEVELS))
+            sys.exit(1)
+        if args.engine == 'reference' or args.check_parity:
+            print('Incremental and chunked runs use the vectorized engine only.')
+            sys.exit(1)
+
+    if args.batch:
+        if args.incremental or args.chunksize:
+            print('--batch runs the full pipeline; it cannot be combined with --incremental or --chunksize.')
+            sys.exit(1)
+        inputs = find_batch_inputs(args.batch, header_idx=header_idx)
+        start = time.perf_counter()
+        with profiler.stage('run_batch') as record:
+            results = run_batch(inputs, outdir, workers=args.workers or None, engine=args.engine,
+                                fill_fractions=fill_fractions, levels=levels, parity=args.check_parity,
+                                lean=args.lean)
+            record['rows_out'] = sum(r['rows'] for r in results)
+        print_batch_report(results, time.perf_counter() - start)
+        profiler.report(outdir)
+        failed = [r for r in results if r['error'] is not None or r['parity_errors']]
+        for r in results:
+            for col, n in r.get('parity_errors') or []:
+                print(f"{r['symbol']}: parity mismatch in {col}: {n} rows differ from reference engine")
+        if failed:
+            sys.exit(1)
+        return 'Done.'
+
+    checkpoint = None
+    if args.incremental and os.path.exists(checkpoint_path):
+        try:
+            checkpoint = load_checkpoint(checkpoint_path)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        if tuple(checkpoint['levels']) != levels or tuple(checkpoint['fill_fractions']) != fill_fractions:
+            print('Checkpoint was built with different --levels/--gap-fills; rerun without --incremental.')
+            sys.exit(1)
+
+    if checkpoint is not None or args.chunksize:
+        if args.chunksize:
+            chunks = iter_data_chunks(args.input, header_idx=header_idx, chunksize=args.chunksize)
+        else:
+            chunks = [load_data(args.input, header_idx=header_idx)]
+        try:
+            with profiler.stage('stream_backtest') as record:
+                checkpoint, processed = stream_backtest(chunks, outdir, levels=levels,
+                                                        fill_fractions=fill_fractions, checkpoint=checkpoint)
+                record['rows_out'] = processed
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        if not processed:
+            print('No new bars to process - outputs are up to date.')
+            return None
+        if args.incremental or os.path.exists(checkpoint_path):
+            with profiler.stage('save_checkpoint'):
+                save_checkpoint(checkpoint, checkpoint_path)
+        profiler.report(outdir)
+        return f'Processed {processed} bars.'
+
+    try:
+        with profiler.stage('load_data') as record:
+            df = load_data(args.input, header_idx=header_idx)
+            record['rows_out'] = len(df)
+    except Exception as e:
+        print('Failed to read input file:', e)
+        sys.exit(1)
+
+    try:
+        with profiler.stage('normalize_ohlc', df) as record:
+            df = normalize_ohlc(df)
+            record['rows_out'] = len(df)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
-    print('Done. CSVs written to', args.output)
+    if args.sweep:
+        with open(args.sweep) as f:
+            grid = sweep_grid(json.load(f))
+        start = time.perf_counter()
+        with profiler.stage('sweep_features', df):
+            features = sweep_features(df, fill_fractions=fill_fractions)
+        with profiler.stage('run_sweep', features) as record:
+            ranking = run_sweep(features, grid, outdir, workers=args.workers or None,
+                                fill_fractions=fill_fractions, min_count=args.sweep_min_count)
+            record['rows_out'] = len(ranking)
+        print(ranking.head(10).to_string(index=False))
+        profiler.report(outdir)
+        return f'{len(grid)} combinations in {time.perf_counter() - start:.3f}s.'
+
+    stats, parity_errors = run_pipeline(df, outdir, engine=args.engine, fill_fractions=fill_fractions,
+                                        levels=levels, parity=args.check_parity, profiler=profiler,
+                                        lean=args.lean)
+
+    if args.walk_forward:
+        with profiler.stage('walk_forward', df):
+            scores = walk_forward(df, outdir, min_count=args.walk_forward_min_count)
+        print(scores.to_string(index=False))
+
+    # a full run (re)starts the checkpoint that later --incremental runs append to
+    if args.incremental or os.path.exists(checkpoint_path):
+        with profiler.stage('save_checkpoint', df):
+            save_checkpoint(build_checkpoint(df, levels, fill_fractions), checkpoint_path)
+
+    profiler.report(outdir)
+
+    if args.check_parity:
+        if parity_errors:
+            for col, n in parity_errors:
+                print(f'Parity mismatch in {col}: {n} rows differ from reference engine')
+            sys.exit(1)
+        print('Parity check passed: vectorized and reference engines agree.')
+
+    return 'Done.'
 
 
 if __name__ == '__main__':
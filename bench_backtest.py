@@ -0,0 +1,263 @@
+"""
+Benchmarks for the backtest pipeline on synthetic OHLC data.
+
+Usage:
+  python bench_backtest.py --rows 1000000
+  python bench_backtest.py --suite --sizes 10k,100k,1M,10M --json bench_results.json
+  python bench_backtest.py --stage rolling_quantile --windows 20,60,250 --quantiles 0.1,0.3,0.5,0.7,0.9
+
+The default mode compares the array-based classification and aggregation engines in backtest_nifty.py
+against the original row-by-row reference engines and prints rows/sec for each. --suite times every
+stage of the pipeline at each size (wall time, rows/sec, peak traced memory) and writes the results
+as JSON so runs from different versions can be diffed.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import backtest_nifty as bt
+
+
+# (drift, close-to-close sd, wick sd) per regime, in percent per bar
+REGIMES = {
+    'trend_up': (0.15, 0.9, 0.35),
+    'trend_down': (-0.15, 1.1, 0.45),
+    'chop': (0.0, 0.6, 0.55),
+}
+# log-price band the walk is reflected into (about 5,000 - 20,000 around 10,000)
+LOG_PRICE_BAND = 0.7
+
+
+def make_synthetic_ohlc(n, seed=0):
+    """
+    Daily-style OHLC series `n` rows long with trending and choppy regimes.
+
+    Regimes last 5-60 bars. Overnight gaps are mostly small, with occasional
+    heavy-tailed jumps, so every gap bucket and candle state gets populated.
+    The log-price walk is reflected into a fixed band so long series keep a
+    realistic price level.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(5, 61, size=n // 5 + 1)
+    regime = np.repeat(rng.integers(0, len(REGIMES), size=len(lengths)), lengths)[:n]
+    drift, vol, wick = (np.array(v)[regime] / 100 for v in zip(*REGIMES.values()))
+
+    gap = rng.normal(0, 0.25, n) * vol + np.where(rng.random(n) < 0.05, rng.standard_t(3, n) * 0.008, 0)
+    body = drift + rng.normal(0, 1, n) * vol
+    # open and close of every bar as one walk: prev close -> open -> close -> next open ...
+    walk = np.cumsum(np.column_stack([gap, body]).ravel()) / LOG_PRICE_BAND
+    folded = np.mod(walk + 1, 4)
+    path = 10000 * np.exp(LOG_PRICE_BAND * (np.where(folded > 2, 4 - folded, folded) - 1))
+    open_, close = path[0::2], path[1::2]
+    high = np.maximum(open_, close) * np.exp(np.abs(rng.normal(0, 1, n)) * wick)
+    low = np.minimum(open_, close) * np.exp(-np.abs(rng.normal(0, 1, n)) * wick)
+    if n <= 60_000:
+        dates = pd.bdate_range('1800-01-01', periods=n)
+    else:
+        # minute spacing keeps 10M+ rows inside the datetime64[ns] range
+        dates = pd.date_range('2000-01-01', periods=n, freq='min')
+    return pd.DataFrame({'Date': dates, 'Open': open_.round(2), 'High': high.round(2),
+                         'Low': low.round(2), 'Close': close.round(2)})
+
+
+def time_stage(stage, df, **kwargs):
+    start = time.perf_counter()
+    stage(df, **kwargs)
+    return time.perf_counter() - start
+
+
+def result(stage, engine, n, elapsed, peak_mb=None, frame_mb=None):
+    return {'stage': stage, 'engine': engine, 'rows': n, 'seconds': elapsed,
+            'rows_per_sec': n / elapsed if elapsed > 0 else float('inf'), 'peak_mb': peak_mb,
+            'frame_mb': frame_mb}
+
+
+def bench_open_context(df, skip_reference=False):
+    rows = []
+    engines = ['vectorized'] if skip_reference else ['reference', 'vectorized']
+    for engine in engines:
+        elapsed = time_stage(bt.classify_open_context, df, engine=engine)
+        rows.append(result('classify_open_context', engine, len(df), elapsed))
+    return rows
+
+
+def bench_aggregate(df, skip_reference=False):
+    # the reference aggregator substring-matches the composite outcome strings
+    if 'next_day_outcome' not in df.columns:
+        df['next_day_outcome'] = bt.compose_next_day_outcome(df)
+    rows = []
+    engines = ['vectorized'] if skip_reference else ['reference', 'vectorized']
+    with tempfile.TemporaryDirectory() as outdir:
+        for engine in engines:
+            elapsed = time_stage(bt.aggregate_and_write, df, outdir=outdir, engine=engine)
+            rows.append(result('aggregate_and_write', engine, len(df), elapsed))
+    return rows
+
+
+def bench_rolling_quantiles(df, windows, quantiles, skip_reference=False):
+    # body_pct_prev is the series classify_previous_candle takes its rolling percentiles of
+    values = df['body_pct_prev'].to_numpy()
+    rows = []
+    for window in windows:
+        stage = f'rolling_quantile_w{window}'
+        if not skip_reference:
+            series = pd.Series(values)
+            start = time.perf_counter()
+            for q in quantiles:
+                series.rolling(window, min_periods=window // 2).quantile(q)
+            rows.append(result(stage, 'pandas', len(values), time.perf_counter() - start))
+        start = time.perf_counter()
+        bt.rolling_quantiles(values, window, quantiles, min_periods=window // 2)
+        rows.append(result(stage, 'kernel', len(values), time.perf_counter() - start))
+    return rows
+
+
+def classify_all(df):
+    """Run every classification stage (vectorized engines) ahead of aggregation."""
+    bt.classify_previous_candle(df)
+    bt.classify_open_context(df)
+    bt.add_next_day_columns(df)
+    bt.label_next_day_outcomes(df)
+    bt.gap_analysis(df)
+
+
+def pipeline_stages(outdir, lean=False):
+    """
+    (name, callable) for each stage of backtest_nifty's pipeline, in run order.
+
+    With `lean` every stage is followed by backtest_nifty.shrink_frame, as in
+    `backtest_nifty.py --lean`.
+    """
+    level_daily = {}  # compute_level_game_stats' per-day table, which level_scenario_stats aggregates
+    stages = [
+        ('add_prev_day_features', bt.add_prev_day_features),
+        ('classify_previous_candle', bt.classify_previous_candle),
+        ('classify_open_context', bt.classify_open_context),
+        ('add_next_day_columns', bt.add_next_day_columns),
+        ('label_next_day_outcomes', lambda df: bt.label_next_day_outcomes(df, composite=False)),
+        ('gap_analysis', bt.gap_analysis),
+        ('aggregate_and_write', lambda df: bt.aggregate_and_write(df, outdir)),
+        ('compute_level_game_stats', lambda df: level_daily.update(table=bt.compute_level_game_stats(df, outdir))),
+        ('level_scenario_stats', lambda df: bt.write_level_scenario_stats(level_daily['table'], outdir)),
+    ]
+    if lean:
+        stages = [(name, lambda df, name=name, stage=stage: (stage(df), bt.shrink_frame(df, name)))
+                  for name, stage in stages]
+    return stages
+
+
+def bench_pipeline(n, seed=0, trace_memory=True, lean=False):
+    """
+    Time every pipeline stage on an `n`-row synthetic series.
+
+    tracemalloc slows allocation-heavy stages (CSV writing most of all), so
+    peak memory, and the deep size of the frame after each stage, come from a
+    second, traced pass over a fresh copy of the series rather than from the
+    timed one.
+    """
+    engine = 'lean' if lean else 'vectorized'
+    rows = []
+    with tempfile.TemporaryDirectory() as outdir:
+        df = make_synthetic_ohlc(n, seed=seed)
+        for name, stage in pipeline_stages(outdir, lean):
+            rows.append(result(name, engine, n, time_stage(stage, df)))
+        if trace_memory:
+            df = make_synthetic_ohlc(n, seed=seed)
+            tracemalloc.start()
+            try:
+                for row, (name, stage) in zip(rows, pipeline_stages(outdir, lean)):
+                    tracemalloc.reset_peak()
+                    base = tracemalloc.get_traced_memory()[0]
+                    stage(df)
+                    row['peak_mb'] = (tracemalloc.get_traced_memory()[1] - base) / 2**20
+                    row['frame_mb'] = bt.frame_memory_mb(df)
+            finally:
+                tracemalloc.stop()
+    return rows
+
+
+def parse_sizes(text):
+    """'10k,100k,1M' -> [10000, 100000, 1000000]."""
+    scale = {'k': 1_000, 'm': 1_000_000}
+    sizes = []
+    for item in text.split(','):
+        item = item.strip().lower()
+        sizes.append(int(float(item[:-1]) * scale[item[-1]]) if item[-1] in scale else int(item))
+    return sizes
+
+
+def environment():
+    try:
+        # run in the script's checkout, not the caller's working directory
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'pandas': pd.__version__, 'machine': platform.machine(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def print_results(rows):
+    print(f"{'stage':<28}{'engine':<12}{'rows':>10}{'seconds':>10}{'rows/sec':>14}{'peak MB':>10}{'frame MB':>10}")
+    for r in rows:
+        peak = f"{r['peak_mb']:>10.1f}" if r['peak_mb'] is not None else f"{'':>10}"
+        frame = f"{r['frame_mb']:>10.1f}" if r['frame_mb'] is not None else f"{'':>10}"
+        print(f"{r['stage']:<28}{r['engine']:<12}{r['rows']:>10}{r['seconds']:>10.3f}{r['rows_per_sec']:>14,.0f}"
+              f"{peak}{frame}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', '-n', type=int, default=1_000_000, help='Synthetic rows to generate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-reference', action='store_true', help='Only time the vectorized engines')
+    parser.add_argument('--stage', choices=['all', 'open_context', 'aggregate', 'rolling_quantile'], default='all')
+    parser.add_argument('--windows', default='20,60,120,250',
+                        help='Comma-separated windows for the rolling_quantile stage')
+    parser.add_argument('--quantiles', default='0.3,0.7',
+                        help='Comma-separated quantiles computed per window by the rolling_quantile stage')
+    parser.add_argument('--suite', action='store_true',
+                        help='Time every pipeline stage at each of --sizes instead of comparing engines')
+    parser.add_argument('--sizes', default='10k,100k,1M,10M', help='Comma-separated row counts for --suite')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the traced pass that measures peak memory')
+    parser.add_argument('--lean', action='store_true',
+                        help='--suite: shrink the frame after every stage as backtest_nifty.py --lean does')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = []
+    if args.suite:
+        for n in parse_sizes(args.sizes):
+            rows = bench_pipeline(n, seed=args.seed, trace_memory=not args.no_memory, lean=args.lean)
+            print_results(rows)
+            results += rows
+    else:
+        df = make_synthetic_ohlc(args.rows, seed=args.seed)
+        bt.add_prev_day_features(df)
+        if args.stage in ('all', 'rolling_quantile'):
+            windows = [int(w) for w in args.windows.split(',')]
+            quantiles = [float(q) for q in args.quantiles.split(',')]
+            results += bench_rolling_quantiles(df, windows, quantiles, skip_reference=args.skip_reference)
+        if args.stage in ('all', 'open_context'):
+            results += bench_open_context(df, skip_reference=args.skip_reference)
+        if args.stage in ('all', 'aggregate'):
+            classify_all(df)
+            results += bench_aggregate(df, skip_reference=args.skip_reference)
+        print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'environment': environment(), 'seed': args.seed, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()